@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Benchmark of the output profiles (see profiles.py) on a processed file.
+
+The file is rewritten once per profile. For every profile the write time, the file size and the time to read the field
+tile by tile like rasdaman does with "insitu": true (aligned tiles of <time>x<lat>x<lon>, e.g. 6x0x0 for the tiling
+"aligned [0:0,0:0,0:0,0:5,0:420,0:460]") are reported. The page cache of every file is dropped before it is read
+(posix_fadvise), so the tiles are read from disk as far as the filesystem allows.
+"""
+
+#===== imports    =================================================
+
+import sys
+import os
+import time
+import itertools
+import tempfile
+from netCDF4 import Dataset
+
+from profiles import TIME_DIMS
+from profiles import LAT_DIMS
+from profiles import LON_DIMS
+from profiles import parse_profile
+from profiles import needs_netcdf4
+from profiles import variable_options
+
+
+# ======================= List of functions ====================================== #
+
+
+def write_profile(in_file, out_file, profile):
+    """
+    Copies in_file with the chunking and compression of the profile for all variables with dimensions.
+    @param in_file: processed netCDF-file
+    @param out_file: name of the netCDF-file to be created
+    @param profile: OutputProfile
+    @return: seconds needed for the write (including closing the file)
+    """
+    with Dataset(in_file, "r") as template:
+        data = {name: var[:] for name, var in template.variables.items() if len(var.dimensions) > 0}
+        start = time.time()
+        with Dataset(out_file, "w", format="NETCDF4_CLASSIC" if needs_netcdf4(profile) else "NETCDF3_CLASSIC") as out:
+            out.setncatts({name: template.getncattr(name) for name in template.ncattrs()})
+            for name, dimension in template.dimensions.items():
+                out.createDimension(name, None if dimension.isunlimited() else len(dimension))
+            for name, in_var in template.variables.items():
+                fill_value = in_var.getncattr("_FillValue") if "_FillValue" in in_var.ncattrs() else None
+                options = variable_options(profile, in_var.dimensions, in_var.shape) if name in data else {}
+                out_var = out.createVariable(name, in_var.datatype, in_var.dimensions, fill_value=fill_value, **options)
+                out_var.setncatts({attr: in_var.getncattr(attr) for attr in in_var.ncattrs() if attr != "_FillValue"})
+                if name in data:
+                    out_var[:] = data[name]
+                else:
+                    out_var.assignValue(in_var.getValue())
+    return time.time() - start
+
+
+def field_name(nc_file):
+    """
+    @param nc_file: open netCDF4.Dataset
+    @return: name of the largest variable with a time, latitude and longitude dimension
+    """
+    fields = [(var.size, name) for name, var in nc_file.variables.items()
+              if any(dim in TIME_DIMS for dim in var.dimensions) and any(dim in LAT_DIMS for dim in var.dimensions)
+              and any(dim in LON_DIMS for dim in var.dimensions)]
+    if not fields:
+        raise ValueError("No field with time, latitude and longitude dimension found.")
+    return max(fields)[1]
+
+
+def read_tiles(nc_path, tile):
+    """
+    Reads the field of the file tile by tile (aligned tiles, the last ones may be smaller).
+    @param nc_path: netCDF-file
+    @param tile: tile shape (time, lat, lon), 0: whole dimension
+    @return: number of tiles, seconds needed for reading all of them
+    """
+    with open(nc_path, "rb") as in_file:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(in_file.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+    start = time.time()
+    with Dataset(nc_path, "r") as nc_file:
+        var = nc_file.variables[field_name(nc_file)]
+        steps = []
+        for dim, size in zip(var.dimensions, var.shape):
+            length = size
+            for index, names in enumerate((TIME_DIMS, LAT_DIMS, LON_DIMS)):
+                if dim in names:
+                    length = tile[index] or size
+            steps.append(range(0, size, length) if size > 0 else [0])
+            steps[-1] = [slice(first, first + length) for first in steps[-1]]
+        tiles = 0
+        for slices in itertools.product(*steps):
+            _ = var[slices]
+            tiles = tiles + 1
+    return tiles, time.time() - start
+
+
+def run_benchmark(in_file, tile, specs, work_dir):
+    """
+    Benchmarks every profile on in_file.
+    @param in_file: processed netCDF-file
+    @param tile: tile shape (time, lat, lon) of the reads
+    @param specs: profile strings (see profiles.parse_profile())
+    @param work_dir: directory for the rewritten files (removed after every profile)
+    @return: list of (spec, write time, size in bytes, number of tiles, read time)
+    """
+    results = []
+    for spec in specs:
+        out_file = "{0}/profile.nc".format(work_dir)
+        write_time = write_profile(in_file, out_file, parse_profile(spec))
+        size = os.path.getsize(out_file)
+        tiles, read_time = read_tiles(out_file, tile)
+        os.remove(out_file)
+        results.append((spec, write_time, size, tiles, read_time))
+    return results
+
+
+#==================================================================
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: ./benchmark_profiles.py <FILE> <TILE> <PROFILE> [<PROFILE> ...]")
+        print("FILE= processed file (processed:YYYYMMDDHH.mEE.nc) the profiles are tested with")
+        print("TILE= tile shape rasdaman reads, <time>x<lat>x<lon> (0: whole dimension), e.g. 6x0x0")
+        print("PROFILE= output profile, e.g. none 6x0x0:shuffle:zlib:4 1x128x128:zlib:1 (see profiles.py)")
+        sys.exit()
+    dat_file = sys.argv[1]
+    if not os.path.isfile(dat_file):
+        print(dat_file + ": This needs to be a processed file")
+        sys.exit()
+    tile_shape = parse_profile(sys.argv[2]).chunks or (0, 0, 0)
+    print("{0:<32} {1:>10} {2:>12} {3:>7} {4:>10} {5:>12}".format("profile", "write [s]", "size [MB]", "tiles",
+                                                                  "read [s]", "per tile [ms]"))
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(dat_file))) as bench_dir:
+        for spec, write_time, size, tiles, read_time in run_benchmark(dat_file, tile_shape, sys.argv[3:], bench_dir):
+            print("{0:<32} {1:>10.3f} {2:>12.2f} {3:>7d} {4:>10.3f} {5:>12.2f}"
+                  .format(spec, write_time, size / 1024 ** 2, tiles, read_time, 1000 * read_time / max(tiles, 1)))
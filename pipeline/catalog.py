@@ -0,0 +1,169 @@
+"""
+Persistent catalog of the GRIB archive.
+
+Every input file (cde*) of the source directories is stored once in a SQLite database with its day, forecast hour,
+member, size, mtime and whether it was converted already (every file holds all model runs of its day, forecast hour
+and member). A job lists every day directory and compares the mtime and size of its files with the catalog (no file is
+opened), so only new or rewritten files are stored again and questions across months ("which days are incomplete?")
+need no access to the archive at all. The directories are listed by a pool of threads like in
+helper.directory_scanner(), the catalog itself is only used by the master thread of rank 0.
+"""
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+from prepros import get_forecast_hour
+from prepros import get_member
+from merger import convert_time
+from helper import SCAN_THREADS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    day TEXT NOT NULL,
+    forecast_hour INTEGER,
+    member TEXT,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (directory);
+CREATE INDEX IF NOT EXISTS files_day ON files (day, member, forecast_hour);
+"""
+
+
+# ======================= List of functions ====================================== #
+
+
+def open_catalog(db_file):
+    """
+    Opens the catalog and creates its tables if they do not exist yet.
+    @param db_file: path of the SQLite database
+    @return: sqlite3.Connection
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(db_file)), exist_ok=True)
+    connection = sqlite3.connect(db_file, timeout=60)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def list_directory(path):
+    """
+    Lists the input files of one day directory with their mtime and size (no access to the catalog, so several
+    directories can be listed at the same time).
+    @param path: path of the day directory
+    @return: dictionary path of the input file -> (mtime, size)
+    """
+    listing = {}
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.name.startswith("cde") and entry.is_file():
+                stat_info = entry.stat()
+                # same path as in the conversion tasks (see helper.conversion_tasks_builder())
+                listing["{0}/{1}".format(path, entry.name)] = (stat_info.st_mtime, stat_info.st_size)
+    return listing
+
+
+def update_directory(connection, source_dir, job, listing=None):
+    """
+    Brings the catalog entries of one day directory up to date. Files with a changed mtime or size are stored again
+    as not processed.
+    @param connection: open catalog (see open_catalog())
+    @param source_dir: directory of the day directories
+    @param job: name of the day directory
+    @param listing: input files of the directory (see list_directory()), None: the directory is listed here
+    @return: number of files that were added, changed or removed
+    """
+    path = "{0}/{1}".format(source_dir, job)
+    if listing is None:
+        listing = list_directory(path)
+    stored = {row[0]: (row[1], row[2]) for row in
+              connection.execute("SELECT path, mtime, size FROM files WHERE directory = ?", (path,))}
+    day = convert_time(os.path.normpath(path))
+    changed = []
+    for file_path, (mtime, size) in sorted(listing.items()):
+        if stored.get(file_path) == (mtime, size):
+            continue
+        name = os.path.basename(file_path)
+        try:
+            forecast_hour = get_forecast_hour(name)
+        except (ValueError, IndexError):
+            forecast_hour = None
+        changed.append((file_path, path, day, forecast_hour, get_member(name), size, mtime))
+    removed = [(file_path,) for file_path in stored if file_path not in listing]
+
+    with connection:  # one transaction per directory
+        connection.executemany("INSERT OR REPLACE INTO files (path, directory, day, forecast_hour, member, size, mtime, "
+                               "processed) VALUES (?, ?, ?, ?, ?, ?, ?, 0)", changed)
+        connection.executemany("DELETE FROM files WHERE path = ?", removed)
+    return len(changed) + len(removed)
+
+
+def catalog_scanner(connection, source_path):
+    """
+    Updates the catalog for all day directories of source_path and returns the same results as
+    helper.directory_scanner() (load level 0) from it.
+    @param connection: open catalog (see open_catalog())
+    @param source_path: directory of the day directories (e.g. .../<year>/<month>/)
+    @return: dir_detail_list, list_items_to_process, total_size_source, total_num_files, total_num_directories,
+             file_records (see helper.directory_scanner(), sizes are the file sizes in KB)
+    """
+    list_directories = sorted(os.listdir(source_path))
+    list_items_to_process = [d for d in list_directories if os.path.isdir("{0}/{1}".format(source_path, d))]
+    # the directories are listed at the same time (the listing waits for the metadata server), the catalog is updated
+    # by this thread
+    updated = 0
+    with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+        listings = pool.map(list_directory, ["{0}/{1}".format(source_path, job) for job in list_items_to_process])
+        for job, listing in zip(list_items_to_process, listings):
+            updated = updated + update_directory(connection, source_path, job, listing)
+
+    dir_detail_list = []
+    file_records = {}
+    total_size_source = 0
+    total_num_files = 0
+    for job in list_items_to_process:
+        records = connection.execute("SELECT path, forecast_hour, member, size FROM files WHERE directory = ? "
+                                     "ORDER BY path", ("{0}/{1}".format(source_path, job),)).fetchall()
+        size = sum(record[3] for record in records) // 1024
+        dir_detail_list.extend([job, size, len(records)])
+        file_records[job] = [tuple(record) for record in records]
+        total_size_source = total_size_source + size
+        total_num_files = total_num_files + len(records)
+    print("Catalog : {0} files of {1} directories updated".format(updated, len(list_items_to_process)))
+    return dir_detail_list, list_items_to_process, float(total_size_source / 1000000), total_num_files, \
+        len(list_directories), file_records
+
+
+def mark_processed(connection, paths):
+    """
+    Records that the given input files are converted.
+    @param connection: open catalog (see open_catalog())
+    @param paths: paths of the input files (as in the conversion tasks)
+    """
+    with connection:
+        connection.executemany("UPDATE files SET processed = 1 WHERE path = ?", [(path,) for path in paths])
+
+
+def incomplete_days(connection, source_path, max_hour, num_members=20):
+    """
+    Lists the days of source_path that do not have all input files (members x forecast hours, one file holds all model
+    runs) or whose files are not converted yet. The last forecast hour of a day is taken from its files (up to
+    max_hour), as the older archive only goes to hour 21.
+    @param connection: open catalog (see open_catalog())
+    @param source_path: directory of the day directories (as given to catalog_scanner())
+    @param max_hour: last forecast hour that is processed
+    @param num_members: members per model run
+    @return: list of (day, number of files, expected number of files, number of processed files)
+    """
+    prefix = "{0}/".format(source_path)  # the day directories are stored as <source_path>/<job>
+    rows = connection.execute("SELECT day, COUNT(*), SUM(processed), MAX(forecast_hour) FROM files "
+                              "WHERE forecast_hour <= ? AND substr(directory, 1, ?) = ? GROUP BY day ORDER BY day",
+                              (max_hour, len(prefix), prefix)).fetchall()
+    days = []
+    for day, num_files, processed, last_hour in rows:
+        expected = num_members * (last_hour + 1)
+        if num_files < expected or processed < num_files:
+            days.append((day, num_files, expected, processed))
+    return days
@@ -20,6 +20,8 @@ from mpi4py import MPI
 scriptName = sys.argv[0]
 year = sys.argv[1]
 month = sys.argv[2]
+# --resume : the batch file continues a previous run of the month (see main.py), without it the month starts from scratch
+resume = "--resume" in sys.argv[3:]
 #year = "2017" 
 #month = "01"
 logger_ID = year + month 
@@ -54,12 +56,29 @@ def create_parameter_file(file_name, year, month):
     f.write('REMAPPED_DIRS = remapped\n')
     f.write('NATIVE_VARS =\n')
     f.write('NATIVE_DIRS = ""\n') 
+    f.write('OUTPUT_PROFILES = 6x0x0:shuffle:zlib:6\n')
+    f.write('Local_Workers = 1\n')
+    f.write('Master_Works = false\n')
+    f.write('Shutdown_Margin = 900\n')
+    f.write('Decoder = cdo\n')
+    f.write('Remap_Engine = weights\n')
+    f.write('Accumulate = false\n')
+    f.write('Max_Subprocesses = 1\n')
+    f.write('Cores_Per_Rank = 0\n')
+    f.write('Scratch_Directory = $TMPDIR\n')
+    f.write('Prefetch_Budget = 2048\n')
+    f.write('Catalog_File = /p/project/deepacf/deeprain/mozaffari1/rasdaman/remaped_precip/rasdaman/input/catalog.sqlite\n')
     f.close()
 
-def create_batch_file(file_name, template_file, parameter_file_name, script_name, destination):
+def create_batch_file(file_name, template_file, parameter_file_name, script_name, destination, resume=False):
     copyfile(template_file, file_name)
     f = open(file_name, "a")
-    f.write("srun python {script} {parameters} {dest}".format(script=script_name, parameters=parameter_file_name, dest=destination))
+    # --resume : a job that is stopped by its deadline can be continued by submitting a batch file created with
+    # "creator.py <year> <month> --resume" (e.g. sbatch --dependency=afterany:<job_id>). It is opt-in : with --resume
+    # the units recorded in the manifest are skipped and their outputs are kept, also after a fix of the code
+    resume_flag = " --resume" if resume else ""
+    f.write("srun python {script} {parameters} {dest}{resume}".format(script=script_name, parameters=parameter_file_name,
+                                                                     dest=destination, resume=resume_flag))
 
 def main():
     comm = MPI.COMM_WORLD
@@ -82,7 +101,9 @@ def main():
         parameter_file_name = "parameters_Rasdaman_{year}{month}.dat".format(year=year, month=month)
         batch_file_name = "s{year}{month}_Batch_hdfml_Rasdaman_WF_.sh".format(year=year, month=month)
         create_parameter_file(parameter_file_name, year, month)
-        create_batch_file(batch_file_name, template_file, parameter_file_name, script_name, destination)
+        if resume:  # the batch file of the first run of the month stays as it is
+            batch_file_name = "s{year}{month}_Batch_hdfml_Rasdaman_WF_resume.sh".format(year=year, month=month)
+        create_batch_file(batch_file_name, template_file, parameter_file_name, script_name, destination, resume)
         logger.info(" Parameters file is created with name : {parameter_file_name}".format(parameter_file_name = parameter_file_name))
         logger.info(" Batch file is created with name : {batch_file_name}".format(batch_file_name = batch_file_name))
 
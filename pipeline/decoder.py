@@ -0,0 +1,92 @@
+"""
+In-process decoding of the COSMO-EPS GRIB files with the ecCodes python bindings.
+
+The input file is read once and only the messages of the requested variables are decoded. This replaces the
+grib_filter + cdo copy round trip of prepros.split_to_variable() and prepros.grib_to_netcdf().
+ecCodes is optional: without it the pipeline uses the external tools (Decoder = cdo in the parameter file).
+"""
+from datetime import datetime, timedelta
+import numpy as np
+
+from exception import SlaveError
+
+try:
+    import eccodes
+except ImportError:  # the external tools are used instead
+    eccodes = None
+
+
+# ======================= List of functions ====================================== #
+
+
+def eccodes_available():
+    """
+    @return: True if the ecCodes python bindings can be used for decoding
+    """
+    return eccodes is not None
+
+
+def decode_grib(in_file, variables):
+    """
+    Decodes all messages of in_file whose shortName is in variables.
+    Every message is returned as a dictionary with the field and its metadata:
+    values (2D masked array, rlat x rlon with increasing rlat), model_start and valid_time (datetime), step (forecast
+    hour), member (perturbation number), long_name, units and param (GRIB2 number.category.discipline, the order of cdo).
+    @param in_file: GRIB file (cdeYYYYMMDD.FF.mEE.grib2)
+    @param variables: short names of the variables that should be decoded
+    @return: dictionary variable name -> list of the decoded messages sorted by valid_time
+    """
+    if eccodes is None:
+        raise SlaveError(function="decode_grib()", message="The ecCodes python bindings are not installed.")
+
+    fields = {}
+    with open(in_file, "rb") as grib_file:
+        while True:
+            gid = eccodes.codes_grib_new_from_file(grib_file)
+            if gid is None:
+                break
+            try:
+                var_name = eccodes.codes_get(gid, "shortName")
+                if var_name not in variables:
+                    continue
+                fields.setdefault(var_name, []).append(decode_message(gid))
+            finally:
+                eccodes.codes_release(gid)
+
+    for var_name in fields:
+        fields[var_name].sort(key=lambda field: field["valid_time"])
+    return fields
+
+
+def decode_message(gid):
+    """
+    Reads the field and the metadata of one GRIB message (see decode_grib()).
+    @param gid: ecCodes handle of the message
+    @return: dictionary with the field and its metadata
+    """
+    eccodes.codes_set(gid, "stepUnits", "h")
+    ni = eccodes.codes_get(gid, "Ni")
+    nj = eccodes.codes_get(gid, "Nj")
+
+    values = eccodes.codes_get_values(gid).reshape(nj, ni)
+    if eccodes.codes_get(gid, "jScansPositively") == 0:
+        values = values[::-1, :]  # the native grid is stored with increasing rlat
+    if eccodes.codes_get(gid, "bitmapPresent"):
+        values = np.ma.masked_equal(values, eccodes.codes_get(gid, "missingValue"))
+    else:
+        values = np.ma.masked_array(values)
+
+    model_start = datetime.strptime("{0:08d}{1:04d}".format(eccodes.codes_get(gid, "dataDate"),
+                                                            eccodes.codes_get(gid, "dataTime")), "%Y%m%d%H%M")
+    step = eccodes.codes_get(gid, "endStep")
+
+    return {"values": values.astype(np.float32),
+            "model_start": model_start,
+            "valid_time": model_start + timedelta(hours=step),
+            "step": step,
+            "member": eccodes.codes_get(gid, "perturbationNumber"),
+            "long_name": eccodes.codes_get(gid, "name"),
+            "units": eccodes.codes_get(gid, "units"),
+            "param": "{0}.{1}.{2}".format(eccodes.codes_get(gid, "parameterNumber"),
+                                          eccodes.codes_get(gid, "parameterCategory"),
+                                          eccodes.codes_get(gid, "discipline"))}
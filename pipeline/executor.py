@@ -0,0 +1,148 @@
+"""
+Execution of the external tools (cdo, nco, ..) used by the pipeline.
+
+The commands are split with shlex and started directly, without a /bin/sh in between. At most max_concurrent
+commands run at the same time on a rank (Max_Subprocesses in the parameter file), no matter if they are started one by
+one or submitted as a batch. Every invocation is recorded with the step of the pipeline it belongs to, its wall time,
+exit code and the tail of its stderr, so the time spent in the external tools can be reported at the end of the job.
+The cores of the rank are split between the concurrent commands: cdo gets -P <threads> and the NCO tools get
+--thr_nbr=<threads>, so the node is neither oversubscribed nor idle.
+"""
+import os
+import shlex
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+STDERR_TAIL = 2000  # characters of stderr that are kept for every command
+
+max_concurrent = 1  # number of commands running at the same time on this rank (see set_max_concurrent())
+tool_threads = 1  # threads of every command (see set_max_concurrent())
+_slots = threading.BoundedSemaphore(max_concurrent)
+_pool = None  # threads that start the commands of the batches
+_records = []  # one record per finished command (see run_command())
+_lock = threading.Lock()
+
+
+# ======================= List of functions ====================================== #
+
+
+def set_max_concurrent(num, cores=None):
+    """
+    Sets the number of commands that may run at the same time on this rank and splits the cores of the rank between
+    them. Must be called before the first command.
+    @param num: maximum number of concurrent commands (at least 1)
+    @param cores: number of cores of the rank (default: see available_cores())
+    @return: number of threads every command gets
+    """
+    global max_concurrent, tool_threads, _slots, _pool
+    max_concurrent = max(int(num), 1)
+    tool_threads = max((cores or available_cores()) // max_concurrent, 1)
+    _slots = threading.BoundedSemaphore(max_concurrent)
+    _pool = None
+    return tool_threads
+
+
+def available_cores():
+    """
+    Returns the number of cores this rank may use: the affinity mask set by srun/mpirun (all cores of the node if
+    there is none), limited by SLURM_CPUS_PER_TASK if the ranks are not bound to their cores.
+    @return: number of cores
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = len(os.sched_getaffinity(0))
+    else:
+        cores = os.cpu_count() or 1
+    if "SLURM_CPUS_PER_TASK" in os.environ:
+        cores = min(cores, int(os.environ["SLURM_CPUS_PER_TASK"]))
+    return cores
+
+
+def thread_flags(args, threads):
+    """
+    Adds the option for the number of threads to the arguments of cdo and the NCO tools (unless it is given already).
+    @param args: the split command line
+    @param threads: number of threads the command may use
+    @return: the arguments with the option
+    """
+    tool = os.path.basename(args[0])
+    if threads <= 1:
+        return args
+    if tool == "cdo" and "-P" not in args:
+        return [args[0], "-P", str(threads)] + args[1:]
+    if tool in ("ncap2", "ncpdq", "ncks", "ncrcat", "ncecat") and \
+            not any(arg.startswith(("--thr_nbr", "-t")) for arg in args[1:]):
+        return [args[0], "--thr_nbr={0}".format(threads)] + args[1:]
+    return args
+
+
+def run_command(shell_args, step=None):
+    """
+    Runs one command and waits until it is finished.
+    @param shell_args: the command line (quoting like in a shell, but no pipes or redirections)
+    @param step: step of the pipeline the command belongs to (default: name of the tool)
+    @return: record of the command, dictionary with step, command, threads, exit_code, wall_time (s) and stderr (tail)
+    """
+    args = thread_flags(shlex.split(shell_args), tool_threads)
+    record = {"step": step or args[0], "command": shell_args, "threads": tool_threads}
+    with _slots:
+        start = time.time()
+        try:
+            process = subprocess.run(args, stderr=subprocess.PIPE)
+            record["exit_code"] = process.returncode
+            record["stderr"] = process.stderr.decode(errors="replace")[-STDERR_TAIL:]
+        except OSError as err:  # e.g. the tool is not installed
+            record["exit_code"] = 127
+            record["stderr"] = str(err)
+        record["wall_time"] = time.time() - start
+    with _lock:
+        _records.append(record)
+    return record
+
+
+def submit_command(shell_args, step=None):
+    """
+    Starts one command in the background (see run_command()).
+    @return: future of the record of the command
+    """
+    global _pool
+    with _lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=max_concurrent)
+        pool = _pool
+    return pool.submit(run_command, shell_args, step)
+
+
+def run_batch(commands, step=None):
+    """
+    Runs independent commands concurrently (at most max_concurrent at a time) and waits until all of them are
+    finished.
+    @param commands: list of command lines
+    @param step: step of the pipeline the commands belong to
+    @return: records of the commands in the order of commands
+    """
+    futures = [submit_command(shell_args, step) for shell_args in commands]
+    return [future.result() for future in futures]
+
+
+def command_records():
+    """
+    @return: copy of the records of all commands finished on this rank so far
+    """
+    with _lock:
+        return list(_records)
+
+
+def summarize_records(records):
+    """
+    Sums up the records per step of the pipeline.
+    @param records: records of the commands (see command_records())
+    @return: list of lines "<step>: <number> commands, <wall time> s, <number> failed"
+    """
+    steps = {}
+    for record in records:
+        calls, wall_time, failed = steps.get(record["step"], (0, 0., 0))
+        steps[record["step"]] = (calls + 1, wall_time + record["wall_time"], failed + (record["exit_code"] != 0))
+    return ["{0}: {1} commands, {2:.1f} s, {3} failed".format(step, calls, wall_time, failed)
+            for step, (calls, wall_time, failed) in sorted(steps.items())]
@@ -6,8 +6,20 @@ import subprocess
 import logging
 import time
 import hashlib
+import glob
 from os import listdir
 from os.path import isfile, join
+from datetime import datetime, timedelta
+
+from concurrent.futures import ThreadPoolExecutor
+
+from prepros import get_forecast_hour
+from prepros import get_member
+from merger import convert_time
+from merger import fragment_index
+from planner import availability_bitmap
+from planner import plan_bitmap
+from planner import write_gap_report
 
 # ini. MPI
 comm = MPI.COMM_WORLD
@@ -23,36 +35,81 @@ if my_rank == 0:  # node is master
     logger.addHandler(logging.StreamHandler(sys.stdout))
 
 
+SCAN_THREADS = 16  # directories that are scanned at the same time (the scan waits for the metadata server)
+
+
+def disk_usage(path):
+
+    # Size of the directory tree in bytes like "du -sc" (allocated blocks of the files, subdirectories and the
+    # directory) counted with os.scandir in this process
+    usage = os.stat(path).st_blocks * 512
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                usage = usage + disk_usage(entry.path)
+            else:
+                usage = usage + entry.stat(follow_symlinks=False).st_blocks * 512
+    return usage
+
+
+def file_record(path, size):
+
+    # Record (path, forecast_hour, member, size) of an input file cdeYYYYMMDD.HH.mEE.grib2, forecast_hour and member
+    # are None if they are not part of the name
+    try:
+        forecast_hour = get_forecast_hour(path)
+    except (ValueError, IndexError):
+        forecast_hour = None
+    return path, forecast_hour, get_member(path), size
+
+
+def scan_day_directory(path):
+
+    # Scans one day directory : size in KB (like du -sc), number of files and the records of the input files (cde*)
+    # -> (size, num_files, file_records)
+    usage = os.stat(path).st_blocks * 512
+    num_files = 0
+    file_records = []
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                usage = usage + disk_usage(entry.path)
+                continue
+            stat_info = entry.stat(follow_symlinks=False)
+            usage = usage + stat_info.st_blocks * 512
+            if entry.is_file():
+                num_files = num_files + 1
+                if entry.name.startswith("cde"):
+                    file_records.append(file_record(entry.path, stat_info.st_size))
+    file_records.sort()
+    return usage // 1024, num_files, file_records
+
+
 def directory_scanner(source_path,load_level):
     # Take a look inside a directories and make a list of ll the folders, sub directories, number of the files and size
     # NOTE : It will neglect if there is a sub-directories inside directories!!!
     # NOTE : It will discriminate between the load level : sub-directories / Files 
+    # NOTE : The directories are scanned with os.scandir by a pool of threads (no du process per directory)
 
     dir_detail_list = []  # directories details
     list_items_to_process = []
     total_size_source = 0
     total_num_files = 0
     list_directories = []
-    
+    file_records = {}  # item to process -> records (path, forecast_hour, member, size) of its input files
+
     ## =================== Here will be for the Files ================= ##
 
     if load_level == 1:
-        #onlyfiles = []
-        #print(source_path)
-
-
-        #onlyfiles = [f for f in listdir(source_path) if isfile(join(source_path, f))]
-        #print(onlyfiles)
-
         # Listing all the files in the directory 
-        for  dirpath, dirnames, filenames in os.walk(source_path): 
-            list_items_to_process.extend(filenames)
- 
-        for f in list_items_to_process :
-            path = source_path + str(f)
-            statinfo = os.stat(path)         
-            size = statinfo.st_size
-            total_size_source = total_size_source + int(size)     
+        with os.scandir(source_path) as entries:
+            for entry in entries:
+                if entry.is_file():
+                    size = entry.stat().st_size
+                    list_items_to_process.append(entry.name)
+                    file_records[entry.name] = [file_record(entry.path, size)]
+                    total_size_source = total_size_source + int(size)
+        list_items_to_process.sort()
 
         total_num_files  = len(list_items_to_process) # number of the files in the source 
         total_num_directories = int(0)      # TODO need to unify the concept as the number of items 
@@ -60,29 +117,25 @@ def directory_scanner(source_path,load_level):
     ## ===================== Here will be for the directories ========== ## 
 
     if load_level == 0:
-        list_directories = []
-
-        list_directories = os.listdir(source_path)
+        list_directories = sorted(os.listdir(source_path))
 
         for d in list_directories:
             # TODO : use os.path.join("foo","bar")
-    
             path = source_path + d 
             if os.path.isdir(path):
                 list_items_to_process.append(d)
-                list_items_to_process.sort()
-                num_files = 0
-                # size of the files and subdirectories
-                size_dir = subprocess.check_output(['du', '-sc', path])
-                splitted = size_dir.split()  # fist item is the size of the folder
-                size = (splitted[0])
-                num_files = len([f for f in os.listdir(path) if os.path.isfile(os.path.join(path, f))])
-                dir_detail_list.extend([d, size, num_files])
-                total_num_files = total_num_files + int(num_files)
-                total_size_source = total_size_source + int(size)
             else:
                 message = path,'does not exist'
                 logger.error(message) 
+
+        # size of the files and subdirectories, the directories are scanned at the same time
+        with ThreadPoolExecutor(max_workers=SCAN_THREADS) as pool:
+            scans = pool.map(scan_day_directory, [source_path + d for d in list_items_to_process])
+            for d, (size, num_files, records) in zip(list_items_to_process, scans):
+                dir_detail_list.extend([d, size, num_files])
+                file_records[d] = records
+                total_num_files = total_num_files + int(num_files)
+                total_size_source = total_size_source + int(size)
                      
         total_num_directories = int(len(list_directories))
 
@@ -105,8 +158,10 @@ def directory_scanner(source_path,load_level):
     # total_size_source  === > Total size of the items to process 
     # total_num_files    === > for Sub - Directories : sum of all files in different directories / for Files is sum of all 
     # total_num_directories  === > for Files = 0 
+    # file_records   === > item to process -> (path, forecast_hour, member, size) of every input file (cde*)
         
-    return dir_detail_list, list_items_to_process, total_size_source, total_num_files, total_num_directories
+    return dir_detail_list, list_items_to_process, total_size_source, total_num_files, total_num_directories, \
+        file_records
 
 # Source - Directoy 
 # Destination Rirectory 
@@ -147,39 +202,143 @@ def data_structure_builder (source_dir, destination_dir, dir_detail_list, list_i
     return 
 
 
-def load_distributor(dir_detail_list, list_items_to_process, total_size_source, total_num_files, total_num_directories,load_level, processor_num):
+def work_queue_builder(source_dir, dir_detail_list, list_items_to_process, load_level):
 
-    # create a dictionary with p number of keys
-    # for each directory they add the name to one of the keys
-    transfer_dict = dict.fromkeys(list(range(1, processor_num)))
-    logger.info("The follwoing is in the load Balancer ")
-    logger.info(transfer_dict) 
-    logger.info(list_items_to_process)
-    logger.info(total_num_directories)
-    logger.info(total_num_files)
-    
-    # package_counter = 0 possibility to use the counter to fill
-    counter = 1
+    # Order the items to process by their size (largest first) so the pull-based scheduler hands out the slowest
+    # work at the beginning and the small items fill the gaps at the end of the run
+    # dir_detail_list is flat : [name, size, num_files, name, size, num_files, ...]
+    item_sizes = {}
 
     if load_level == 0:
-        for Directory_counter in range(0, total_num_directories):
-            if transfer_dict[counter] is None:  # if the value for the key is None add to it
-                transfer_dict[counter] = list_items_to_process[Directory_counter]
-            else:  # if key has a value join the new value to the old value
-                transfer_dict[counter] = "{};{}".format(transfer_dict[counter], list_items_to_process[Directory_counter])
-            counter = counter + 1
-            if counter == processor_num:
-                counter = 1
+        for index in range(0, len(dir_detail_list), 3):
+            item_sizes[dir_detail_list[index]] = int(dir_detail_list[index + 1])
 
     if load_level == 1:
-        for Directory_counter in range(0, total_num_files):
-            if transfer_dict[counter] is None:  # if the value for the key is None add to it
-                transfer_dict[counter] = list_items_to_process[Directory_counter]
-            else:  # if key has a value join the new value to the old value
-                transfer_dict[counter] = "{};{}".format(transfer_dict[counter], list_items_to_process[Directory_counter])
-            counter = counter + 1
-            if counter == processor_num:
-                counter = 1
-            
-    logging.info(transfer_dict)
-    return transfer_dict
+        for f in list_items_to_process:
+            item_sizes[f] = os.stat(source_dir + str(f)).st_size
+
+    work_queue = sorted(list_items_to_process, key=lambda item: item_sizes.get(item, 0), reverse=True)
+    logger.info("The work queue (largest first) is : {work_queue}".format(work_queue=work_queue))
+    return work_queue
+
+
+def conversion_tasks_builder(source_dir, work_queue, max_hour, file_records=None):
+
+    # Phase 1 : one task (job, input_file) for every input file of the directories in work_queue
+    # only files with forecast_hour between 0 and max_hour are processed, the largest files are handed out first
+    # file_records of the directory scanner are used if given, otherwise the directories are listed again
+    conversion_tasks = []
+    for job in work_queue:
+        if file_records is not None and job in file_records:
+            records = [("{0}/{1}/{2}".format(source_dir, job, os.path.basename(path)), forecast_hour, size)
+                       for path, forecast_hour, member, size in file_records[job]]
+        else:
+            records = [(input_file, get_forecast_hour(input_file), os.stat(input_file).st_size)
+                       for input_file in glob.glob("{0}/{1}/cde*".format(source_dir, job))]
+        for input_file, forecast_hour, size in records:
+            if forecast_hour is None or forecast_hour > max_hour:
+                logger.info("File {input_file} is skipped".format(input_file=input_file))
+                continue
+            conversion_tasks.append((size, job, input_file))
+
+    conversion_tasks.sort(key=lambda task: task[0], reverse=True)
+    logger.info("Number of conversion tasks : {num}".format(num=len(conversion_tasks)))
+    return [(job, input_file) for size, job, input_file in conversion_tasks]
+
+
+def merge_tasks_builder(destination_dir, work_queue, variables):
+
+    # Phase 2 : one task (job, var, model_run, member) for every model run (00, 03, .., 21) and member (01, .., 20)
+    # of every variable of the directories in work_queue
+    merge_tasks = []
+    members = [str(m).zfill(2) for m in range(1, 21)]  # ["01", "02", ..]
+    for job in work_queue:
+        first_run = convert_time(destination_dir + "/" + job)
+        first_run = datetime.strptime("{date}-{hour}".format(date=first_run, hour="00"), "%Y%m%d-%H")
+        for var in variables:
+            for run in range(0, 8):
+                model_run = first_run + timedelta(hours=3 * run)
+                for member in members:
+                    merge_tasks.append((job, var, model_run, member))
+
+    logger.info("Number of merge tasks : {num}".format(num=len(merge_tasks)))
+    return merge_tasks
+
+
+def merge_tasks_indexer(destination_dir, merge_tasks, deaccumulate=None, resume=False):
+
+    # Attaches the time steps to every merge task : (job, var, model_run, member) -> (job, var, model_run, member,
+    # fragments, plan). Every variable directory is listed once (see merger.fragment_index()), so the slaves do not
+    # search the directory again for every model run and member
+    # deaccumulate (variable -> flag) : the availability of the time steps of every day and variable is planned up
+    # front (see planner.py) and written to <day>/gaps_<var>.txt, without it the plan is None (chosen by the slave)
+    # resume : an existing gap report is kept, the time steps of the units finished before are removed already and
+    # would be reported as missing (the report is written before the first merge task is sent)
+    indexes = {}
+    plans = {}
+    indexed_tasks = []
+    for task in merge_tasks:
+        job, var, model_run, member = task[:4]
+        var_dir = "{path}/{job}/{var}".format(path=destination_dir, job=job, var=var)
+        if var_dir not in indexes:
+            indexes[var_dir] = fragment_index(var_dir) if os.path.isdir(var_dir) else {}
+            if deaccumulate is not None:
+                first_run = datetime.strptime(convert_time(destination_dir + "/" + job), "%Y%m%d")
+                bitmap = availability_bitmap(indexes[var_dir], first_run)
+                plans[var_dir] = plan_bitmap(bitmap, deaccumulate[var])
+                report_file = "{path}/{job}/gaps_{var}.txt".format(path=destination_dir, job=job, var=var)
+                title = "gap report of {var} on {day}".format(var=var, day=first_run.strftime("%Y-%m-%d"))
+                if not (resume and os.path.isfile(report_file)):
+                    write_gap_report(report_file, bitmap, plans[var_dir], title)
+        fragments = indexes[var_dir].get((model_run.strftime("%Y%m%d-%H"), member), [])
+        plan = None
+        if var_dir in plans:
+            plan = plans[var_dir][(model_run.hour // 3, int(member) - 1)]
+        indexed_tasks.append((job, var, model_run, member, fragments, plan))
+
+    logger.info("Time steps of {num} variable directories are indexed".format(num=len(indexes)))
+    return indexed_tasks
+
+
+def accumulation_tasks_builder(source_dir, work_queue, variables):
+
+    # Accumulation mode : one task (job, var, member) for every member (01, .., 20) and variable of the directories in
+    # work_queue. A task reads all input files of its member and writes the processed files of the 8 model runs
+    accumulation_tasks = []
+    members = [str(m).zfill(2) for m in range(1, 21)]  # ["01", "02", ..]
+    for job in work_queue:
+        for var in variables:
+            for member in members:
+                accumulation_tasks.append((job, var, member))
+
+    logger.info("Number of accumulation tasks : {num}".format(num=len(accumulation_tasks)))
+    return accumulation_tasks
+
+
+def job_deadline(deadline_arg=None):
+
+    # Returns the end of the allocation in seconds since the epoch (None if it is unknown)
+    # 1. deadline_arg : --deadline=<YYYY-mm-ddTHH:MM:SS> / --deadline=<seconds since epoch> / --deadline=+<seconds>
+    # 2. SLURM_JOB_END_TIME of the batch environment
+    # 3. end time of the job reported by squeue
+    if deadline_arg:
+        if deadline_arg.startswith("+"):
+            return time.time() + float(deadline_arg[1:])
+        try:
+            return float(deadline_arg)
+        except ValueError:
+            return time.mktime(datetime.strptime(deadline_arg, "%Y-%m-%dT%H:%M:%S").timetuple())
+
+    if "SLURM_JOB_END_TIME" in os.environ:
+        return float(os.environ["SLURM_JOB_END_TIME"])
+
+    if "SLURM_JOB_ID" in os.environ:
+        try:
+            end_time = subprocess.check_output(["squeue", "-h", "-j", os.environ["SLURM_JOB_ID"], "-o", "%e"])
+            end_time = end_time.decode(sys.stdout.encoding).strip()
+            return time.mktime(datetime.strptime(end_time, "%Y-%m-%dT%H:%M:%S").timetuple())
+        except (OSError, subprocess.CalledProcessError, ValueError):
+            logger.warning("The end time of job {job} could not be read from squeue".format(
+                job=os.environ["SLURM_JOB_ID"]))
+
+    return None
@@ -6,26 +6,70 @@ import os
 import shutil
 import glob
 from datetime import datetime, timedelta
+import numpy as np
 
 from helper import directory_scanner
-from helper import load_distributor
+from helper import work_queue_builder
 from helper import data_structure_builder
+from helper import conversion_tasks_builder
+from helper import merge_tasks_builder
+from helper import accumulation_tasks_builder
+from helper import merge_tasks_indexer
+from helper import job_deadline
 
-from prepros import get_forecast_hour
 from prepros import split_to_variable
 from prepros import define_nc_file
 from prepros import define_out_file_path
 from prepros import grib_to_netcdf
-from prepros import split_time_steps
-from prepros import rename_splitted_data
+from prepros import split_and_rename_time_steps
+from prepros import write_decoded_time_steps
+from prepros import create_decoded_file
+from prepros import read_grid_description
+from prepros import get_forecast_hour
+from prepros import scratch_dir
+
+from decoder import eccodes_available
+from decoder import decode_grib
+
+from remapper import sparse_available
+from remapper import weights_file
+from remapper import generate_weights
 
-from merger import convert_time
-from merger import move_files
 from merger import build_data
 from merger import remove_data
+from merger import processed_files
+from merger import stack_time_steps
+from merger import write_processed
+from merger import convert_time
+from merger import fragment_hours
 
 from exception import MainError
 
+from scheduler import master_scheduler
+from scheduler import worker_loop
+
+from stager import InputStager
+
+from profiles import parse_profile
+
+from catalog import open_catalog
+from catalog import catalog_scanner
+from catalog import mark_processed
+from catalog import incomplete_days
+
+from executor import set_max_concurrent
+from executor import command_records
+from executor import summarize_records
+
+from manifest import manifest_path
+from manifest import read_manifest
+from manifest import append_manifest
+from manifest import pending_tasks
+from manifest import clean_partial_data
+
+from nclock import NETCDF_LOCK
+from nclock import open_dataset
+
 # for the local machine test
 current_path = os.path.dirname(os.path.abspath(__file__))
 os.chdir(current_path)
@@ -42,11 +86,17 @@ p = comm.Get_size()  # number of assigned nods
 scriptName = sys.argv[0]
 fileName = sys.argv[1]
 filePath = sys.argv[2]
+RESUME = "--resume" in sys.argv[3:]  # continue a previous run of the job instead of starting from scratch
+deadline_arg = None  # --deadline=<YYYY-mm-ddTHH:MM:SS | seconds since epoch | +seconds>, default: end of the SLURM job
+for arg in sys.argv[3:]:
+    if arg.startswith("--deadline="):
+        deadline_arg = arg.split("=", 1)[1]
 
 if my_rank == 0:  # node is master
     print("The script name is  : {name}".format(name=scriptName))
     print("The Parameters file name is  : {name}".format(name=fileName))
     print("The Parameters file path is  : {name}".format(name=filePath))
+    print("Resume a previous run  : {resume}".format(resume=RESUME))
 
 fileObj = open(fileName)
 params = {}
@@ -64,8 +114,8 @@ destination_dir = str(params["Destination_Directory"])  # where the processed da
 input_dir = str(params["Input_Directory"])  # where the setup and the config files are located
 load_level = int(params["Load_Level"]) # It can be 0 whihc means monthly and 1 means daily
 MAX_HOUR = int(params["MAX_HOUR"]) # defaultt for Cosmo-EPS is 21 now
-COMPRESS_LEVEL = str(params["COMPRESS_LEVEL"]) # we never used this!
-COMPRESS_LEVEL = 6  # TODO: @amirpasha : need perm. fix!
+COMPRESS_LEVEL = int(params["COMPRESS_LEVEL"])  # deflate level of the processed files (0: no compression)
+INTERMEDIATE_COMPRESS_LEVEL = 0  # the intermediate files are read again right away : no compression
 variables = str(params["variables"])
 variables = variables.split(",") #TODO 
 DEACUMMULATE_VARS = str(params["DEACUMMULATE_VARS"])
@@ -92,6 +142,22 @@ NATIVE_VARS = str(params["NATIVE_VARS"])
 NATIVE_VARS=NATIVE_VARS.split(",") #TODO 
 NATIVE_DIRS = str(params["NATIVE_DIRS"])
 NATIVE_DIRS=NATIVE_DIRS.split(",") #TODO 
+# chunking, shuffle and codec of the processed files per variable, e.g. 6x461x421:shuffle:zlib:4 (see profiles.py)
+OUTPUT_PROFILES = str(params.get("OUTPUT_PROFILES", "")).split(",")
+OUTPUT_PROFILES = [parse_profile(OUTPUT_PROFILES[index] if index < len(OUTPUT_PROFILES) else "", COMPRESS_LEVEL)
+                   for index in range(len(variables))]  # "": deflate at COMPRESS_LEVEL
+# number of tasks processed at the same time on each rank (threads, their netCDF I/O is serialized, see nclock.py)
+LOCAL_WORKERS = int(params.get("Local_Workers", 1))
+MASTER_WORKS = params.get("Master_Works", "false").lower() == "true" or p == 1  # the master processes tasks too
+SHUTDOWN_MARGIN = float(params.get("Shutdown_Margin", 900))  # seconds before the deadline no new task is handed out
+DECODER = params.get("Decoder", "cdo")  # cdo: grib_filter + cdo / eccodes: in-process decoding of the input files
+REMAP_ENGINE = params.get("Remap_Engine", "weights")  # weights: precomputed weights applied in-process / cdo: remapcon
+MAX_SUBPROCESSES = int(params.get("Max_Subprocesses", LOCAL_WORKERS))  # external tools running at once on each rank
+PREFETCH_BUDGET = float(params.get("Prefetch_Budget", 0)) * 1024 ** 2  # MB of inputs staged ahead per rank (0: off)
+SCRATCH_DIRECTORY = os.path.expandvars(params.get("Scratch_Directory", ""))  # intermediate files ("": destination)
+CORES_PER_RANK = int(params.get("Cores_Per_Rank", 0))  # cores of each rank, 0: from the affinity mask / SLURM
+ACCUMULATE = params.get("Accumulate", "false").lower() == "true"  # decoded fields are merged in memory (no time steps)
+CATALOG_FILE = params.get("Catalog_File", "")  # SQLite catalog of the source files kept across jobs ("": no catalog)
 
 if my_rank == 0:  # node is master
     print(variables)
@@ -107,12 +173,35 @@ if my_rank == 0:  # node is master
     print(REMAPPED_DIRS)
     print(NATIVE_VARS)
     print(NATIVE_DIRS)
+    print(OUTPUT_PROFILES)
+    print(LOCAL_WORKERS)
+    print(MASTER_WORKS)
+    print(SHUTDOWN_MARGIN)
+    print(DECODER)
+    print(REMAP_ENGINE)
+    print(ACCUMULATE)
+    print(MAX_SUBPROCESSES)
+    print(CORES_PER_RANK)
+    print(SCRATCH_DIRECTORY)
+    print(PREFETCH_BUDGET)
+    print(CATALOG_FILE)
     
 in_grid = os.path.join(input_dir, "grid_des", "cde_grid")   # CDO grid description file for native COSMO grid
 tar_reg_grid = os.path.join(input_dir, "grid_des", "cde_grid_unrot_invlat") # CDO grid description file for unrotated, regular
                                                                             # target grid with decreasing latitude ordering
 ingest_file = input_dir + "/ingest-files.nc"  # file where all ingestions are stored in #ToDO. add folder for ingestion files
 missing_path= input_dir + "/missing" #TODO: create directory where all missing-files are stored
+# the cores of the rank are split between the external tools running at the same time (cdo -P, ncap2 --thr_nbr)
+tool_threads = set_max_concurrent(MAX_SUBPROCESSES, CORES_PER_RANK or None)
+if my_rank == 0:
+    print("Threads of every external tool : {threads}".format(threads=tool_threads))
+scratch_root = None  # split directories and temporary directories of the merging are created here
+if SCRATCH_DIRECTORY and "$" not in SCRATCH_DIRECTORY:  # e.g. $TMPDIR is not set : no scratch
+    scratch_root = "{path}/job_{job_id}".format(path=SCRATCH_DIRECTORY, job_id=job_id)
+stager = None  # stages the input files of the task received ahead (slaves only, see worker_loop())
+INTERMEDIATE_FACTOR = 4  # intermediate files need up to this many times the size of the (compressed) input
+weights_dir = params.get("Weights_Directory", input_dir + "/weights")  # where the weights for remapping are cached
+catalog = None  # open catalog of the source files (master only, see catalog.py)
 
 # ==================================== Master Logging ==================================================== #
 # DEBUG: Detailed information, typically of interest only when diagnosing problems.
@@ -131,10 +220,10 @@ if my_rank == 0:  # node is master
 
     ## unified log path
     log_path = current_path + '/logs_{job_id}/'.format(job_id=job_id)
-    if os.path.exists(log_path):
+    if os.path.exists(log_path) and not RESUME:
         print('Log path for Job_iD:{job_id}  exsits-> Log directory is deleted'.format(job_id=job_id))
         shutil.rmtree(log_path)
-    os.mkdir(log_path)
+    os.makedirs(log_path, exist_ok=True)
 
     logger_path_main = log_path + 'Main_log_job_{job_id}.log'.format(job_id=job_id)
     if os.path.isfile(logger_path_main):
@@ -149,13 +238,27 @@ if my_rank == 0:  # node is master
     start = time.time()  # start of the MPI
     logger.info(' === Distributor is started === ')
 
+    # no new task is handed out after stop_time, so the running ones can finish before the allocation ends
+    deadline = job_deadline(deadline_arg)
+    stop_time = None
+    if deadline is not None:
+        stop_time = deadline - SHUTDOWN_MARGIN
+        logger.info("Deadline of the job : {deadline} -> no new tasks after {stop}"
+                    .format(deadline=time.ctime(deadline), stop=time.ctime(stop_time)))
+
 # check the existence of the source path :
 if not os.path.exists(source_dir):  # check if the source dir. is existing
     if my_rank == 0:
         raise MainError(function="main()->checking", critical="The source does not exist", info="exit status : 1")
 
 # Check if the destination is existing, if so, it will delete and recreate the destination_dir
-if os.path.exists(destination_dir):
+# (unless a previous run is resumed: finished outputs are kept and only the half-written data is cleaned up later.
+# Without a manifest nothing was finished before, so the job starts from scratch)
+manifest_file = manifest_path(destination_dir, job_id)
+if os.path.exists(destination_dir) and RESUME and os.path.isfile(manifest_file):
+    if my_rank == 0:
+        logger.critical('The destination exist -> Resume from {manifest}'.format(manifest=manifest_file))
+elif os.path.exists(destination_dir):
     if my_rank == 0:
         shutil.rmtree(destination_dir)
         os.mkdir(destination_dir)
@@ -180,7 +283,7 @@ worker_log = current_path + '/logs_{job_id}/'.format(job_id=job_id)
 
 slave_log_path = destination_dir + "/log_temp/"  # Place to log each node in STD
 if my_rank == 0:
-    os.mkdir(slave_log_path)
+    os.makedirs(slave_log_path, exist_ok=True)
 
 # check the existence of the Input path :
 if not os.path.exists(input_dir):  # check if the input dir. is existing
@@ -189,6 +292,14 @@ if not os.path.exists(input_dir):  # check if the input dir. is existing
                         info="exit status : 1")
         #TODO: @BOTH does it work to stop the slaves with this MainError too?
 
+# check the decoder of the input files
+if DECODER not in ("cdo", "eccodes") or (DECODER == "eccodes" and not eccodes_available()):
+    if my_rank == 0:
+        raise MainError(function="main()->checking",
+                        critical="Decoder '{0}' is unknown or the ecCodes python bindings are not installed."
+                        .format(DECODER),
+                        info="exit status : 1")
+
 # check in_grid and tar_reg_frid (needed for remapping) in input_dir
 if not os.path.isfile(in_grid):
     if my_rank == 0:
@@ -202,6 +313,309 @@ if not os.path.isfile(tar_reg_grid):
                         critical="The CDO grid description file for the unrotated, regular target grid cannot be found.",
                         info="exit status : 1")
 
+# check the engine for remapping (without SciPy the weights cannot be applied -> cdo remapcon)
+if REMAP_ENGINE not in ("cdo", "weights"):
+    if my_rank == 0:
+        raise MainError(function="main()->checking",
+                        critical="Remap_Engine '{0}' is unknown.".format(REMAP_ENGINE),
+                        info="exit status : 1")
+if REMAP_ENGINE == "weights" and not sparse_available():
+    if my_rank == 0:
+        logger.warning("SciPy is not installed -> the data is remapped with cdo remapcon")
+    REMAP_ENGINE = "cdo"
+remap_weights = None  # weights file for the remapped variables (generated by the master before the merging)
+if REMAP_ENGINE == "weights" and any(REMAPPED_VARS):
+    remap_weights = weights_file(weights_dir, in_grid, tar_reg_grid, "conservative")
+
+# the accumulation mode decodes in-process and remaps in-process (there is no merged file for cdo)
+if ACCUMULATE and (DECODER != "eccodes" or (any(REMAPPED_VARS) and remap_weights is None)):
+    if my_rank == 0:
+        raise MainError(function="main()->checking",
+                        critical="Accumulate = true needs Decoder = eccodes and Remap_Engine = weights (with SciPy).",
+                        info="exit status : 1")
+
+# the slaves start logging into the directories created by the master above
+comm.Barrier()
+
+
+# ================================== Slave : processing of one task ====================================== #
+
+def process_input_file(task):
+    """
+    Phase 1: splits one input file into its variables, converts them to netCDF and splits them into the time steps.
+    The time steps are stored as time:<model_run>.<forecast_hour>.m<member>.nc in the variable directories of the day.
+    Every input file gets its own split directory, so several files of the same day can be processed at the same time.
+    With Decoder = eccodes the file is read once in-process and the time steps are written directly (no split files).
+    @param task: (job, input_file) where job is the name of the day directory
+    @return: report for the master
+    """
+    job, input_file = task
+    logger.info(' Next file to be processed is  {input_file}'.format(input_file=input_file))
+    log.write('INFO: Next files to be processed is  {input_file}\n'.format(input_file=input_file))
+    relative_destination_dir = destination_dir + "/" + job  # relative means destination for the current job
+
+    read_file = input_file if stager is None else stager.path(input_file)  # staged copy if it was prefetched
+
+    if DECODER == "eccodes":
+        # ===== 2.-5. Step === decode the variables in-process and store their time steps ===============
+        fields = decode_grib(read_file, variables)
+        for var_name in fields:
+            out_file_path = define_out_file_path(relative_destination_dir, var_name)
+            write_decoded_time_steps(fields[var_name], out_file_path, input_file, in_grid,
+                                     INTERMEDIATE_COMPRESS_LEVEL)
+            log.write("DEBUG: {num} time steps of {var_name} are stored in {path_name}\n"
+                      .format(num=len(fields[var_name]), var_name=var_name, path_name=out_file_path))
+        if stager is not None:
+            stager.release([input_file])
+        return "Processor {my_rank} report :   / File {input_file} is decoded / .".format(my_rank=my_rank,
+                                                                                          input_file=input_file)
+
+    # create a temporary process directory for this input file (in the scratch if there is enough space)
+    relative_split_dir = scratch_dir(scratch_root, destination_dir, job + "/split_" + os.path.basename(input_file),
+                                     INTERMEDIATE_FACTOR * os.stat(input_file).st_size)
+    relative_filter_file = relative_split_dir + "/split_filter.txt"
+    if os.path.isdir(relative_split_dir):  # left behind by a killed job
+        shutil.rmtree(relative_split_dir)
+    os.makedirs(relative_split_dir)
+    f = open(relative_filter_file, "w")
+    f.write('write "{0}/[shortName].grib[editionNumber]";'.format(relative_split_dir))
+    f.close()
+
+    # ===== 2. Step === split into the variables using filter file =================================
+    split_to_variable(read_file, relative_filter_file)
+    if stager is not None:
+        stager.release([input_file])
+
+    # loop over all variable files that are created during the step before
+    for var_file in os.listdir(relative_split_dir):
+        var_name = var_file.split(".")[0]  # defines the variable name of the given file
+        if var_name not in variables:
+            # This variable should not be imported and thus does not need to be preprocessed
+            log.write("DEBUG: Var skipped")
+        else: # This variables should be imported and need to be preprocessed
+            # ===== 3. Step === Grib -> NetCDF ================================
+            # name after remapping
+            nc_file = define_nc_file(relative_split_dir,input_file)
+            # specify location the file will be stored
+            out_file_path = define_out_file_path(relative_destination_dir,var_name)
+            log.write("DEBUG: Output will be stored at this location {path_name}: "
+                      .format(path_name = out_file_path))
+            # specify actual datafile
+            actual_file = glob.glob(relative_split_dir + "/" + var_file)[0]
+            # convert grib to netCDF-data
+            grib_to_netcdf(actual_file, nc_file, INTERMEDIATE_COMPRESS_LEVEL)
+            log.write("DEBUG: conversion (grib -> netCDF) is done for {file_name}!"
+                      .format(file_name = actual_file))
+            # ==== 4.+5. Step === Split time steps and rename data in one pass =====================
+            split_and_rename_time_steps(out_file_path, nc_file)
+            log.write("DEBUG: split_and_rename_time_steps is done for {file_name}!".format(file_name = nc_file))
+            # ==== 6. Step === Delete (old) netCdf ("parent file") =================================
+            os.remove(nc_file)
+            log.write("DEBUG: parent file is deleted ({file_name})".format(file_name = nc_file))
+    # ==== 7. Step === Delete  =================================================================
+    shutil.rmtree(relative_split_dir)
+    log.write("DEBUG: split directory is deleted ({path_name})\n".format(path_name=relative_split_dir))
+    return "Processor {my_rank} report :   / File {input_file} is converted / .".format(my_rank=my_rank,
+                                                                                        input_file=input_file)
+
+
+def process_merge_unit(task):
+    """
+    Phase 2: merges the forecast hours of one model run and member of one variable into the processed file.
+    Every task gets its own temporary directory, so all members of a variable can be merged at the same time.
+    @param task: (job, var, model_run, member, fragments, plan) where job is the name of the day directory, fragments
+                 are the time steps of the model run and member and plan is the merge strategy chosen by the master
+                 (see helper.merge_tasks_indexer())
+    @return: report for the master
+    """
+    job, var, model_run, member, fragments, plan = task
+    relative_destination_dir = destination_dir + "/" + job
+    relative_var_dir = "{path}/{var}".format(path=relative_destination_dir, var = var)
+    logger.info("DEBUG: Process data. Variable={var}, Member={member}, Time={time}"
+                .format(var=var, member=member, time=model_run.strftime("%Y%m%d-%H")))
+    # Creating temporary dir. for the model run and member (in the scratch if there is enough space)
+    relative_tempdir = scratch_dir(scratch_root, destination_dir,
+                                   "{job}/{var}/tempdir_{time}_m{member}".format(job=job, var=var,
+                                                                                  time=model_run.strftime("%Y%m%d%H"),
+                                                                                  member=member),
+                                   INTERMEDIATE_FACTOR * sum(os.stat(fragment).st_size for fragment in fragments))
+    # remove the temp_dir if it exits
+    if os.path.isdir(relative_tempdir):
+        shutil.rmtree(relative_tempdir)
+        logger.info("Reletive temp dir exsist --> Deleted")
+    os.makedirs(relative_tempdir)
+    logger.info("DEBUG: Temporary directory created: {path_name}".format(path_name = relative_tempdir))
+    # ==== extract information for building data ===================================================
+    missing_file = "{path}/{var}.missing".format(path = missing_path, var = var)
+    index = variables.index(var)
+    deacummulate_var = DEACUMMULATE_VARS[index]
+    rename_var = RENAME_VARS[index]
+    old_name = VAR_OLD_NAMES[index]
+    new_name = VAR_NEW_NAMES[index]
+    change_units = CHANGE_UNITS[index]
+    units = UNITS[index]
+    change_long_name = CHANGE_LONG_NAMES[index]
+    long_name = LONG_NAMES[index]
+    remapped = REMAPPED_VARS[index]
+    remapped_dir = REMAPPED_DIRS[index]
+    native = NATIVE_VARS[index]
+    native_dir = NATIVE_DIRS[index]
+    output_profile = OUTPUT_PROFILES[index]
+
+    # ==== Build Data to import ====================================================================
+    # the time steps of "model_run" are merged where they are (the tempdir may be on another filesystem)
+    # and the found hours are stored in "existing_hours"
+    hour_files = fragment_hours(fragments)
+    existing_hours = sorted(hour_files)
+    logger.info("DEBUG: Files were found. Hours are: {hours}".format(hours = existing_hours))
+    # build one datafile for model_run for that member
+    build_data(model_run, member, existing_hours, relative_tempdir, relative_var_dir, COMPRESS_LEVEL, in_grid,
+               tar_reg_grid, missing_file, deacummulate_var, rename_var, old_name, new_name,
+               change_units, units, change_long_name, long_name, remapped, remapped_dir, native,
+               native_dir, remap_weights, hour_files, output_profile, plan)   # ML: consider parsing arguments in a dictionary
+    logger.info("DEBUG: Files were build.")
+    # remove all datafiles that where used to build the file above (would be shorter)
+    remove_data(model_run, member, relative_var_dir, relative_tempdir, fragments)
+    logger.info("DEBUG: Files were removed")
+    return "Processor {my_rank} report :   / {var} {time} m{member} of directory {job} is done / ."\
+        .format(my_rank=my_rank, var=var, time=model_run.strftime("%Y%m%d%H"), member=member, job=job)
+
+
+def process_accumulation_unit(task):
+    """
+    Accumulation mode: decodes the variable from all input files of one member of the day and merges the forecast
+    hours of the 8 model runs in memory. The processed files are written directly, no time steps or temporary
+    directories are created.
+    @param task: (job, var, member) where job is the name of the day directory
+    @return: report for the master
+    """
+    job, var, member = task
+    relative_var_dir = "{path}/{var}".format(path=destination_dir + "/" + job, var=var)
+    logger.info("DEBUG: Accumulate data. Variable={var}, Member={member}, Directory={job}"
+                .format(var=var, member=member, job=job))
+    # ==== extract information for building data ===================================================
+    missing_file = "{path}/{var}.missing".format(path = missing_path, var = var)
+    index = variables.index(var)
+    deacummulate_var = DEACUMMULATE_VARS[index]
+
+    # ==== decode all forecast hours of the member =================================================
+    grid = read_grid_description(in_grid)
+    loaded = {}  # model_run -> forecast hour ("07.nc") -> time step
+    template = None  # in-memory file with the structure of a time step
+    input_files = accumulation_inputs(job, member)
+    for input_file in input_files:
+        forecast_hour = get_forecast_hour(input_file)
+        read_file = input_file if stager is None else stager.path(input_file)  # staged copy if it was prefetched
+        for field in decode_grib(read_file, [var]).get(var, []):
+            loaded.setdefault(field["model_start"], {})[str(forecast_hour).zfill(2) + ".nc"] = \
+                {"time": np.array([float(forecast_hour)]), var: field["values"][np.newaxis]}
+            if template is None:
+                template = create_decoded_file("template_{0}_m{1}".format(var, member), var, field,
+                                               float(forecast_hour), grid, input_file, 0, diskless=True)
+    log.write("DEBUG: {num} model runs of {var} m{member} are decoded\n".format(num=len(loaded), var=var,
+                                                                               member=member))
+    if stager is not None:
+        stager.release(input_files)
+
+    # ==== Build Data to import ====================================================================
+    first_run = datetime.strptime("{date}-{hour}".format(date=convert_time(destination_dir + "/" + job), hour="00"),
+                                  "%Y%m%d-%H")
+    try:
+        for run in range(0, 8):
+            model_run = first_run + timedelta(hours=3 * run)
+            stacked = stack_time_steps(model_run, loaded.pop(model_run, {}), missing_file, deacummulate_var)
+            if template is None:  # nothing is decoded: the structure is taken from the missing file
+                with open_dataset(missing_file, "r") as missing_template:
+                    write_accumulated(model_run, member, missing_template, stacked, relative_var_dir, index)
+            else:
+                write_accumulated(model_run, member, template, stacked, relative_var_dir, index)
+            logger.info("DEBUG: Files were build. Time={time}".format(time=model_run.strftime("%Y%m%d-%H")))
+    finally:
+        if template is not None:
+            with NETCDF_LOCK:  # netCDF4 is not thread-safe (see nclock.py)
+                template.close()
+    return "Processor {my_rank} report :   / {var} m{member} of directory {job} is accumulated / ."\
+        .format(my_rank=my_rank, var=var, member=member, job=job)
+
+
+def accumulation_inputs(job, member):
+    """
+    Returns the input files of one member of the day with forecast hour between 0 and MAX_HOUR.
+    @param job: name of the day directory
+    @param member: ensemble member ("01", ..)
+    @return: sorted list of the input files
+    """
+    input_files = glob.glob("{0}/{1}/cde*.m{2}*".format(source_dir, job, member))
+    return sorted(input_file for input_file in input_files if get_forecast_hour(input_file) <= MAX_HOUR)
+
+
+def prefetch_task(task):
+    """
+    Stages the input files of a phase 1 task that is received ahead (see stager.InputStager).
+    @param task: conversion task (job, input_file) or accumulation task (job, var, member)
+    """
+    if len(task) == 2:
+        stager.prefetch([task[1]])
+    else:
+        stager.prefetch(accumulation_inputs(task[0], task[2]))
+
+
+def write_accumulated(model_run, member, template, stacked, relative_var_dir, index):
+    """
+    Writes the processed files of one model run in the accumulation mode (see merger.write_processed()).
+    @param index: position of the variable in the parameter lists
+    """
+    write_processed(model_run, member, template, stacked, None, relative_var_dir, in_grid, tar_reg_grid,
+                    RENAME_VARS[index], VAR_OLD_NAMES[index], VAR_NEW_NAMES[index], CHANGE_UNITS[index], UNITS[index],
+                    CHANGE_LONG_NAMES[index], LONG_NAMES[index], REMAPPED_VARS[index], REMAPPED_DIRS[index],
+                    NATIVE_VARS[index], NATIVE_DIRS[index], remap_weights, OUTPUT_PROFILES[index])
+
+
+def prepare_remap_weights():
+    """
+    Generates the weights for remapping on the master before they are needed (they are kept for the next jobs).
+    """
+    if generate_weights(in_grid, tar_reg_grid, remap_weights, "conservative"):
+        logger.info("Weights for remapping are generated : {weights}".format(weights=remap_weights))
+    else:
+        logger.info("Weights for remapping are reused : {weights}".format(weights=remap_weights))
+
+
+def merge_unit_is_complete(task):
+    """
+    Checks if all outputs of a merge task exist (used when a previous run is resumed).
+    @param task: (job, var, model_run, member[, fragments]) where job is the name of the day directory
+    @return: True if the processed files of the task exist
+    """
+    job, var, model_run, member = task[:4]
+    index = variables.index(var)
+    relative_var_dir = "{path}/{var}".format(path=destination_dir + "/" + job, var=var)
+    outfiles = processed_files(model_run, member, relative_var_dir, REMAPPED_VARS[index], REMAPPED_DIRS[index],
+                               NATIVE_VARS[index], NATIVE_DIRS[index])
+    return len(outfiles) > 0 and all(os.path.isfile(outfile) for outfile in outfiles)
+
+
+def accumulation_unit_is_complete(task):
+    """
+    Checks if the outputs of all 8 model runs of an accumulation task exist (used when a previous run is resumed).
+    @param task: (job, var, member) where job is the name of the day directory
+    @return: True if the processed files of the task exist
+    """
+    job, var, member = task
+    first_run = datetime.strptime("{date}-{hour}".format(date=convert_time(destination_dir + "/" + job), hour="00"),
+                                  "%Y%m%d-%H")
+    return all(merge_unit_is_complete((job, var, first_run + timedelta(hours=3 * run), member)) for run in range(0, 8))
+
+
+def conversion_done(task):
+    """
+    Records a finished phase 1 task in the manifest and its input file as processed in the catalog.
+    @param task: conversion task (job, input_file) or accumulation task (job, var, member)
+    """
+    append_manifest(manifest_file, [task])
+    if catalog is not None and len(task) == 2:
+        mark_processed(catalog, [task[1]])
+
 
 if my_rank == 0:  # node is master
     # ==================================== Master : Directory scanner ================================= #
@@ -209,7 +623,14 @@ if my_rank == 0:  # node is master
     logger.info("The source path is  : {path}".format(path=source_dir))
     logger.info("The destination path is  : {path}".format(path=destination_dir))
     logger.info("==== Directory scanner : start ====")
-    ret_dir_scanner = directory_scanner(source_dir, load_level)
+    if CATALOG_FILE and load_level == 0:  # only the files that changed since the last job are stored again
+        catalog = open_catalog(CATALOG_FILE)
+        ret_dir_scanner = catalog_scanner(catalog, source_dir)
+        for day, num_files, expected, processed in incomplete_days(catalog, source_dir, MAX_HOUR):
+            logger.info("Catalog : day {day} has {num}/{expected} input files, {processed} processed"
+                        .format(day=day, num=num_files, expected=expected, processed=processed))
+    else:
+        ret_dir_scanner = directory_scanner(source_dir, load_level)
 
     # Unifying the naming of this section for both cases : Sub - Directory or File
     # dir_detail_list == > Including the name of the directories, size and number of teh files in each directory / for files is empty
@@ -217,12 +638,14 @@ if my_rank == 0:  # node is master
     # total_size_source  === > Total size of the items to process
     # total_num_files    === > for Sub - Directories : sum of all files in different directories / for Files is sum of all
     # total_num_directories  === > for Files = 0
+    # file_records   === > item to process -> (path, forecast_hour, member, size) of every input file (cde*)
 
     dir_detail_list = ret_dir_scanner[0]
     list_items_to_process = ret_dir_scanner[1]
     total_size_source = ret_dir_scanner[2]
     total_num_files = ret_dir_scanner[3]
     total_num_dir = ret_dir_scanner[4]
+    file_records = ret_dir_scanner[5]
     logger.info("==== Directory scanner : end ====")
 
     # ================================= Master : Data Structure Builder ========================= #
@@ -231,38 +654,102 @@ if my_rank == 0:  # node is master
     data_structure_builder(source_dir, destination_dir, dir_detail_list, list_items_to_process, load_level)
     logger.info("==== Data Structure Builder : end  ====")
 
-    # ===================================  Master : Load Distribution   ========================== #
-
-    logger.info("==== Load Distribution  : start  ====")
-    ret_load_balancer = load_distributor(dir_detail_list, list_items_to_process, total_size_source, total_num_files,
-                                         total_num_dir, load_level, p)
-    transfer_dict = ret_load_balancer
-    logger.info(ret_load_balancer)
-    logger.info("==== Load Distribution  : end  ====")
+    # ===================================  Master : Work Queue   ================================= #
+
+    logger.info("==== Work Queue  : start  ====")
+    work_queue = work_queue_builder(source_dir, dir_detail_list, list_items_to_process, load_level)
+    if ACCUMULATE:  # phase 1 writes the processed files, there is nothing to merge afterwards
+        conversion_tasks = accumulation_tasks_builder(source_dir, work_queue, variables)
+        merge_tasks = []
+    else:
+        conversion_tasks = conversion_tasks_builder(source_dir, work_queue, MAX_HOUR, file_records)
+        merge_tasks = merge_tasks_builder(destination_dir, work_queue, variables)
+    logger.info("==== Work Queue  : end  ====")
+
+    # ===================================  Master : Resume   ===================================== #
+
+    if RESUME:
+        logger.info("==== Resume  : start  ====")
+        removed = clean_partial_data(destination_dir, work_queue)
+        if scratch_root is not None and os.path.isdir(scratch_root):
+            removed = removed + clean_partial_data(scratch_root, work_queue)
+        logger.info("{removed} half-written files and temporary directories are removed".format(removed=removed))
+        done = read_manifest(manifest_file)
+        conversion_tasks = pending_tasks(conversion_tasks, done)
+        merge_tasks = pending_tasks(merge_tasks, done)
+        # outputs are renamed to processed:*.nc when complete, so these units only miss the manifest entry
+        finished_tasks = [task for task in merge_tasks_indexer(destination_dir, merge_tasks)
+                          if merge_unit_is_complete(task)]
+        for job, var, model_run, member, fragments, plan in finished_tasks:
+            remove_data(model_run, member, "{path}/{var}".format(path=destination_dir + "/" + job, var=var), None,
+                        fragments)
+        if ACCUMULATE:
+            finished_tasks = [task for task in conversion_tasks if accumulation_unit_is_complete(task)]
+        append_manifest(manifest_file, finished_tasks)
+        conversion_tasks = pending_tasks(conversion_tasks, read_manifest(manifest_file))
+        merge_tasks = pending_tasks(merge_tasks, read_manifest(manifest_file))
+        logger.info("{num} conversion tasks and {num_merge} merge tasks are left"
+                    .format(num=len(conversion_tasks), num_merge=len(merge_tasks)))
+        logger.info("==== Resume  : end  ====")
 
     # ===================================== Master : Send / Receive =============================== #
 
     logger.info("==== Master Communication  : start  ====")
 
-    # Send : the list of the directories to the nodes
-    for nodes in range(1, p):
-        broadcast_list = transfer_dict[nodes]
-        comm.send(broadcast_list, dest=nodes)
-
-    # Receive : will wait for a certain time to see if it will receive any critical error from the slaves nodes
-    idle_counter = p - len(list_items_to_process)
-    while idle_counter > 1:  # non-blocking receive function
-        message_in = comm.recv()
-        logger.warning(message_in)
-        # print('Warning:', message_in)
-        idle_counter = idle_counter - 1
-
-    # Receive : Message from slave nodes confirming the sync
-    message_counter = 1
-    while message_counter <= len(list_items_to_process):  # non-blocking receive function
-        message_in = comm.recv()
-        logger.info(message_in)
-        message_counter = message_counter + 1
+    master_process_input_file = None
+    master_process_merge_unit = None
+    if MASTER_WORKS:  # the master processes tasks in between servicing the slaves
+        slave_temp_log = slave_log_path + '/log_file_ji_{job_id}_p_{my_rank}.log'.format(job_id=job_id,
+                                                                                       my_rank=my_rank)
+        log = open(slave_temp_log, "w")
+        log.write(' Processor {my_rank} is created this logger\n'.format(my_rank=my_rank))
+        master_process_input_file = process_accumulation_unit if ACCUMULATE else process_input_file
+        master_process_merge_unit = process_merge_unit
+
+    if remap_weights is not None and ACCUMULATE and conversion_tasks:
+        prepare_remap_weights()
+
+    # Phase 1 : Send the input files (accumulation mode: the members) to the slaves asking for work, until the queue
+    # is drained
+    logger.info("==== Phase 1 (conversion) : start  ====")
+    _, conversion_left = master_scheduler(conversion_tasks, p - 1, master_process_input_file, LOCAL_WORKERS,
+                                          conversion_done, stop_time)
+    if remap_weights is not None and merge_tasks and not conversion_left:
+        prepare_remap_weights()  # the weights are computed once for all merge tasks
+    comm.Barrier()  # all time steps are stored before the merging starts
+    logger.info("==== Phase 1 (conversion) : end  ====")
+
+    # the merging needs all time steps : if the deadline stopped the conversion, the next job resumes from here
+    skipped_merge_tasks = []
+    if conversion_left:
+        skipped_merge_tasks = merge_tasks
+        merge_tasks = []
+
+    # the time steps are listed once per variable directory and sent along with the tasks, together with the merge
+    # strategy of every model run and member (the gap reports are written to <day>/gaps_<var>.txt)
+    merge_tasks = merge_tasks_indexer(destination_dir, merge_tasks,
+                                      {var: DEACUMMULATE_VARS[index] for index, var in enumerate(variables)}, RESUME)
+
+    # Phase 2 : Send the (model_run, member, variable) units to the slaves
+    logger.info("==== Phase 2 (merge) : start  ====")
+    _, merge_left = master_scheduler(merge_tasks, p - 1, master_process_merge_unit, LOCAL_WORKERS,
+                                     lambda task: append_manifest(manifest_file, [task]), stop_time)
+    logger.info("==== Phase 2 (merge) : end  ====")
+    merge_left = merge_left + skipped_merge_tasks
+
+    if conversion_left or merge_left:
+        logger.critical("The job is stopped before the deadline: {num} conversion tasks and {num_merge} merge tasks "
+                        "are left -> run again with --resume (finished tasks are recorded in {manifest})"
+                        .format(num=len(conversion_left), num_merge=len(merge_left), manifest=manifest_file))
+
+    # time spent in the external tools of the master (the slaves report their own in their logs)
+    for line in summarize_records(command_records()):
+        logger.info("External tools of the master : {line}".format(line=line))
+
+    if MASTER_WORKS:
+        log.close()
+    if catalog is not None:
+        catalog.close()
 
     # stamp the end of the runtime
     end = time.time()
@@ -276,7 +763,6 @@ if my_rank == 0:  # node is master
 
 else:  # Processor is slave
     # ============================================ Slave : Send / Receive ============================================ #
-    message_in = comm.recv()
 
     # relative logger file for Job
     relative_log = worker_log + 'Slave_log_{my_rank}_job_{job_id}.log'.format(my_rank=my_rank,
@@ -291,159 +777,33 @@ else:  # Processor is slave
     logger.addHandler(logging.StreamHandler(sys.stdout))
     logger.info('Slave logger is activated')
 
-    if message_in is None:  # in case more than number of the dir. processor is assigned !
-        message_out = "Processor : {my_rank} is idle".format(my_rank=my_rank)
-        logger.info(message_out)
-        comm.send(message_out, dest=0)
-
-    else:  # if the Slave node has joblist to do
-        job_list = message_in.split(';')
-        print(" Processor {my_rank} recived {job_list}".format(my_rank=my_rank, job_list=job_list))
-        # relative logger file for Job
-        slave_temp_log = slave_log_path + '/log_file_ji_{job_id}_p_{my_rank}.log'.format(job_id=job_id,
-                                                                                       my_rank=my_rank)
-        log = open(slave_temp_log, "w")
-        log.write(' Processor {my_rank} is created this logger\n'.format(my_rank=my_rank))
-        logger.info(" Processor {my_rank} recived {job_list}".format(my_rank=my_rank, job_list=job_list))
-
-        slave_message = ""
-        for job_count in range(0, len(job_list)):
-            job = job_list[job_count]  # job is the name of the directory(ies) assigned to slave_node
-            logger.info(' Next item to be processed is  {job}'.format(job=job))
-
-            # create a temporary process directory inside the job folder called
-            relative_source_dir = source_dir + "/" + job     # relative means destination for the current job
-            relative_destination_dir = destination_dir + "/" + job
-            relative_split_dir = relative_destination_dir + "/split"
-            relative_filter_file = relative_split_dir + "/split_filter.txt"
-            os.mkdir(relative_split_dir)
-            f = open(relative_filter_file, "w")
-            f.write('write "{0}/[shortName].grib[editionNumber]";'.format(relative_split_dir))
-            f.close()
-
-            ##### ======================== Start ============================ #####
-
-            # ===== 1. Step === preparation ====================================================================
-            # Read- in the ingest files
-            logger.info(' Variables to import are: {variables}'.format(variables=variables))
-            # define all files that should be preprocessed (laying in the given source path)
-            input_files = glob.glob("{0}/cde*".format(relative_source_dir))
-            input_files.sort()
-            # every file in the directory will be processed
-            for input_file in input_files:
-                # only files with forecast_hour between 0 and MAX_HOUR where processed. (We do not need the rest)
-                log.write('INFO: Next files to be processed is  {input_file}\n'.format(input_file=input_file))
-                if get_forecast_hour(input_file) > MAX_HOUR: #TODO Question? if max hour is going to be anything different than 24h
-                    log.write("INFO: Processor {my_rank} is skipped file: {input_file}".format(my_rank=my_rank,
-                                                                                               input_file=input_file))
-                    continue
-                # ===== 2. Step === split into the variables using filter file =================================
-                split_to_variable(input_file, relative_filter_file)
-
-                # loop over all variable files that are created during the step before
-                for var_file in os.listdir(relative_split_dir):
-                    var_name = var_file.split(".")[0]  # defines the variable name of the given file
-                    if var_name not in variables:
-                        # This variable should not be imported and thus does not need to be preprocessed
-                        log.write("DEBUG: Var skipped")
-                    else: # This variables should be imported and need to be preprocessed
-                        # ===== 3. Step === Grib -> NetCDF ================================
-                        # name after remapping
-                        nc_file = define_nc_file(relative_split_dir,input_file)
-                        # specify location the file will be stored
-                        out_file_path = define_out_file_path(relative_destination_dir,var_name)
-                        log.write("DEBUG: Output will be stored at this location {path_name}: "
-                                  .format(path_name = out_file_path))
-                        # specify actual datafile
-                        actual_file = glob.glob(relative_split_dir + "/" + var_file)[0]
-                        # convert grib to netCDF-data
-                        grib_to_netcdf(actual_file, nc_file, COMPRESS_LEVEL)
-                        log.write("DEBUG: conversion (grib -> netCDF) is done for {file_name}!"
-                                  .format(file_name = actual_file))
-                        # ==== 4. Step === Split time steps ====================================================
-                        split_time_steps(nc_file, " ", relative_split_dir)   # TODO: Revise COMPRESS_LEVEL-input (see split_time_steps-function -> can probably be removed)
-                        log.write("DEBUG: split_time_steps is done for {file_name}!".format(file_name = nc_file))
-                        # ==== 5. Step === Rename data =========================================================
-                        rename_splitted_data(out_file_path, nc_file, relative_split_dir)
-                        log.write("DEBUG: rename_splitted_data function is done on {file_name}"
-                                  .format(file_name = nc_file))
-                        # ==== 6. Step === Delete (old) netCdf ("parent file") =================================
-                        os.remove(nc_file)
-                        log.write("DEBUG: parent file is deleted ({file_name})".format(file_name = nc_file))
-            # ==== 7. Step === Delete  =================================================================
-            # cleanup(relative_split_dir,relative_filter_file)
-            print("DEBUG: cleanup function is done on : {relative_split_dir} & {relative_filter_file} "
-                  .format(relative_split_dir=relative_split_dir,relative_filter_file=relative_filter_file))
-            # ==== 8. Step === Merge ===================================================================
-            for var in variables:
-                logger.info("Next variable to be processed is: {var_name}".format(var_name = var))
-                relative_var_dir = "{path}/{var}".format(path=relative_destination_dir, var = var)
-                logger.info("Relative_var_dir is located in {path_name}".format(path_name = relative_var_dir))
-                # Creating temprory dir. for the variebles # TODO comeplete the cms.
-                relative_tempdir = "{path_name}/tempdir".format(path_name = relative_var_dir)
-                logger.info("Relative_tempdir is located in: {path_name}".format(path_name = relative_tempdir))
-                # remove the temp_dir for var if it exits
-                if os.path.isdir(relative_tempdir):
-                    shutil.rmtree(relative_tempdir)
-                    logger.info("Reletive temp dir exsist --> Deleted")
-                os.mkdir(relative_tempdir)
-                logger.info("DEBUG: Temporary directory created: {path_name}".format(path_name = relative_tempdir))
-                # ==== extract information for building data ===================================================
-                missing_file = "{path}/{var}.missing".format(path = missing_path, var = var)
-                index = variables.index(var)
-                deacummulate_var = DEACUMMULATE_VARS[index]
-                rename_var = RENAME_VARS[index]
-                old_name = VAR_OLD_NAMES[index]
-                new_name = VAR_NEW_NAMES[index]
-                change_units = CHANGE_UNITS[index]
-                units = UNITS[index]
-                change_long_name = CHANGE_LONG_NAMES[index]
-                long_name = LONG_NAMES[index]
-                remapped = REMAPPED_VARS[index]
-                remapped_dir = REMAPPED_DIRS[index]
-                native = NATIVE_VARS[index]
-                native_dir = NATIVE_DIRS[index]
-
-                # ==== extract first and last_run ==============================================================
-                first_run = convert_time(relative_destination_dir)
-                last_run = datetime.strptime("{date}-{hour}".format(date=first_run, hour="21"), "%Y%m%d-%H")
-                first_run = datetime.strptime("{date}-{hour}".format(date=first_run, hour="00"), "%Y%m%d-%H")
-
-                logger.info("Import files from {0} to {1}".format(first_run.strftime("%Y-%m-%d:%H"),
-                                                                  last_run.strftime("%Y-%m-%d:%H")))
-                model_run = first_run
-                logger.info("model_run is :  {model_run}".format(model_run = model_run))
-
-                # ==== Build Data to import ====================================================================
-                while model_run <= last_run:
-                    members = [str(m).zfill(2) for m in range(1, 21)]  # ["01", "02", ..]
-                    for member in members:
-                        logger.info("DEBUG: Process data. Member={member}, Time={time}"
-                                    .format(member=member, time=model_run.strftime("%Y%m%d-%H")))
-                        # move all files that belong to "model_run" to relative_tempdir
-                        # and store the found hours in "existing_hours"
-                        existing_hours = move_files(model_run, member, relative_tempdir, relative_var_dir)
-                        logger.info("DEBUG: Files were moved. Hours are: {hours}".format(hours = existing_hours))
-                        # build one datafile for model_run for that member
-                        build_data(model_run, member, existing_hours, relative_tempdir, relative_var_dir, " ", in_grid,
-                                   tar_reg_grid, missing_file, deacummulate_var, rename_var, old_name, new_name,
-                                   change_units, units, change_long_name, long_name, remapped, remapped_dir, native,
-                                   native_dir)   # ML: consider parsing arguments in a dictionary
-                        logger.info("DEBUG: Files were build.")
-                        # remove all datafiles that where used to build the file above (would be shorter)
-                        remove_data(model_run, member, relative_var_dir, relative_tempdir)
-                        logger.info("DEBUG: Files were removed")
-                    logger.info("DEBUG: ============================")
-                    model_run = model_run + timedelta(0, 10800)  # add three hours (go to next model run)
-
-            job_message = "  / Directory {job} is done /".format(job=job)
-            slave_message = slave_message + job_message
-        # Send : the finish message back to master
-        message_out = "Processor {my_rank} report : {in_message} .".format(my_rank=my_rank, in_message=slave_message)
-        comm.send(message_out, dest=0)
-        print(message_out)
-        logger.info('Processor {my_rank} is finished this logger'.format(my_rank=my_rank))
-        print('Processor {my_rank} is finished this logger\n'.format(my_rank=my_rank))
+    # relative logger file for Job
+    slave_temp_log = slave_log_path + '/log_file_ji_{job_id}_p_{my_rank}.log'.format(job_id=job_id,
+                                                                                   my_rank=my_rank)
+    log = open(slave_temp_log, "w")
+    log.write(' Processor {my_rank} is created this logger\n'.format(my_rank=my_rank))
+
+    # Receive : ask the master for the next task until the queue of the phase is drained
+    prefetch = None
+    if PREFETCH_BUDGET > 0:  # the input files of one task received ahead are staged while the current ones run
+        stage_dir = None  # without a scratch the files are read ahead into the page cache
+        if scratch_root is not None:
+            stage_dir = "{path}/inputs_p{my_rank}".format(path=scratch_root, my_rank=my_rank)
+        stager = InputStager(stage_dir, PREFETCH_BUDGET)
+        prefetch = prefetch_task
+    processed = worker_loop(process_accumulation_unit if ACCUMULATE else process_input_file, LOCAL_WORKERS, prefetch)
+    if stager is not None:
+        stager.shutdown()
+        stager = None
+    comm.Barrier()  # wait until all slaves finished the conversion
+    processed = processed + worker_loop(process_merge_unit, LOCAL_WORKERS)
+    if processed == 0:  # in case more than number of the dir. processor is assigned !
+        logger.info("Processor : {my_rank} is idle".format(my_rank=my_rank))
+    for line in summarize_records(command_records()):
+        logger.info("External tools of processor {my_rank} : {line}".format(my_rank=my_rank, line=line))
+    log.close()
+    logger.info('Processor {my_rank} is finished this logger'.format(my_rank=my_rank))
+    print('Processor {my_rank} is finished this logger\n'.format(my_rank=my_rank))
 exit_status = 0
 MPI.Finalize()
 sys.exit(exit_status)
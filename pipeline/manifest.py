@@ -0,0 +1,93 @@
+import os
+import glob
+import shutil
+
+
+# ======================= List of functions ====================================== #
+
+
+def manifest_path(destination_dir, job_id):
+    """
+    Returns the path of the completion manifest of the job. It is stored next to the processed data, so it survives
+    the end of the job and can be read by the next job of a chain.
+    @param destination_dir: where the processed data is placed
+    @param job_id: number of the submitted job
+    @return: path of the manifest
+    """
+    return "{0}/manifest_job_{1}.txt".format(destination_dir, job_id)
+
+
+def manifest_entry(task):
+    """
+    Returns the line that records the given task in the manifest.
+    @param task: conversion task (job, input_file), accumulation task (job, var, member) or merge task
+                 (job, var, model_run, member[, fragments, plan])
+    @return: manifest line (without newline)
+    """
+    if len(task) == 2:
+        job, input_file = task
+        return "convert {0} {1}".format(job, os.path.basename(input_file))
+    if len(task) == 3:
+        job, var, member = task
+        return "accumulate {0} {1} {2}".format(job, var, member)
+    job, var, model_run, member = task[:4]  # the time steps attached to the task are not recorded
+    return "merge {0} {1} {2} {3}".format(job, var, model_run.strftime("%Y%m%d%H"), member)
+
+
+def read_manifest(path):
+    """
+    Reads the entries of all tasks that are recorded as finished.
+    @param path: path of the manifest
+    @return: set of manifest lines, empty if no manifest exists yet
+    """
+    if not os.path.isfile(path):
+        return set()
+    with open(path) as manifest:
+        return set(line.strip() for line in manifest if line.strip())
+
+
+def append_manifest(path, tasks):
+    """
+    Records the given tasks as finished. The lines are flushed to disk right away, so a job that is killed afterwards
+    does not lose them.
+    @param path: path of the manifest
+    @param tasks: list of finished tasks
+    """
+    with open(path, "a") as manifest:
+        for task in tasks:
+            manifest.write(manifest_entry(task) + "\n")
+        manifest.flush()
+        os.fsync(manifest.fileno())
+
+
+def pending_tasks(tasks, done):
+    """
+    Removes the tasks that are already recorded in the manifest.
+    @param tasks: list of tasks
+    @param done: set of manifest lines (see read_manifest())
+    @return: list of the tasks that still need to be processed (same order)
+    """
+    return [task for task in tasks if manifest_entry(task) not in done]
+
+
+def clean_partial_data(destination_dir, work_queue):
+    """
+    Removes what a killed job left behind in the given day directories: the split directories of the conversion,
+    the temporary directories of the merging, half-written outputs (see merger.partial_file()) and gap reports.
+    The time steps (time:*.nc) and the finished outputs (processed:*.nc) are kept.
+    @param destination_dir: where the processed data is placed
+    @param work_queue: list of the day directories
+    @return: number of removed files and directories
+    """
+    removed = 0
+    for job in work_queue:
+        relative_destination_dir = destination_dir + "/" + job
+        for path in glob.glob(relative_destination_dir + "/split_*") + glob.glob(relative_destination_dir + "/*/tempdir*"):
+            shutil.rmtree(path)
+            removed = removed + 1
+        # half-written outputs (<day>/<var>/<dir>/) and gap reports (<day>/, see planner.write_gap_report())
+        for path in glob.glob(relative_destination_dir + "/*/*/.partial-*") + glob.glob(relative_destination_dir +
+                                                                                        "/.partial-*"):
+            os.remove(path)
+            removed = removed + 1
+    return removed
@@ -2,9 +2,21 @@ import os
 import shutil
 import glob
 from datetime import datetime
+from netCDF4 import Dataset
+import numpy as np
 
 from prepros import term_shell
-from prepros import remap_data, modify_native_data
+from prepros import write_like
+from prepros import remap_data
+from prepros import write_native
+from prepros import rechunk_data
+from profiles import default_profile
+from profiles import nccopy_options
+from remapper import read_weights
+from remapper import write_remapped
+from planner import plan_hours
+from nclock import netcdf_locked
+from nclock import open_dataset
 
 
 def convert_time(path):
@@ -50,122 +62,240 @@ def needs_to_create_missing(h, t):
     return True
 
 
-def move_files(model_run, member, tempdir, source_path):
+def fragment_index(source_path):
     """
-    Moves specified files to a specified tempdir.
+    Lists the time steps (time:YYYYMMDD-HH.FF.mEE.nc) of a variable directory once.
 
-    Moves all files that correspond to the given model_run and specified member to a defined tempdir and renames it in the same
-    step to <forecast_hour>.nc. All forecast_hours that exist in our data set will then be stored in 'existing'.
+    Args:
+        source_path (str): the variable directory
+
+    Returns:
+        dict: (model run "YYYYMMDD-HH", member "EE") -> paths of the forecast hours sorted by hour
+    """
+    index = {}
+    for name in os.listdir(source_path):
+        if not (name.startswith("time:") and name.endswith(".nc")):
+            continue
+        parts = name[len("time:"):].split(".")  # [YYYYMMDD-HH][FF][mEE][nc]
+        if len(parts) != 4 or not parts[2].startswith("m"):
+            continue
+        index.setdefault((parts[0], parts[2][1:]), []).append(source_path + "/" + name)
+    for paths in index.values():
+        paths.sort()
+    return index
+
+
+def fragment_hours(fragments):
+    """
+    Maps the time steps of one model run and member to their forecast hours, so they can be merged where they are
+    (no staging in the tempdir, see build_data()).
 
     Args:
-        model_run (datetime): specifies the time when the model run started
-        member (str): specifies the member
+        fragments (list): the time steps (time:YYYYMMDD-HH.FF.mEE.nc, see fragment_index())
 
     Returns:
-        list: all forecast hours that exist for this model run
-    """
-    os.makedirs(tempdir, exist_ok=True)
-    print("DEBUG: Temporary directory created: {path}".format(path = tempdir))
-    # move input files to tempdir
-    exis = []
-    files_to_process = glob.glob(source_path + "/time:" + model_run.strftime("%Y%m%d-%H") + ".*.m" + member + ".nc")
-    files_to_process.sort()
-    print("DEBUG: Number of files to process: {num}".format(num = len(files_to_process)))
-    for act_file in files_to_process:
-        outfile = tempdir + "/" + act_file.split(".")[-3] + ".nc"
-        shutil.copy(act_file, outfile)
-        print("DEBUG: Copied {startfile} to {endfile}".format(startfile = act_file, endfile = outfile))
-        exis.append(outfile.split("/")[-1])
-    print("DEBUG: Returned files: exis={exis}".format(exis=exis))
-    return exis
-
-
-def deaccumulate_data(hours, max_hour, tempdir):
-    in_files = " "
-    index = 1
-    for hour in hours:
-        if index > max_hour:
-            out_file = tempdir + "/" + hour
-            print("Last hour, no subtraction")
+        dict: forecast hour ("FF.nc") -> path of the time step
+    """
+    return {fragment.split(".")[-3] + ".nc": fragment for fragment in fragments}
+
+
+# time and its bounds (cdo: time_bnds), all other time-dependent variables are data variables
+TIME_VARIABLES = ("time", "time_bnds", "time_bounds")
+
+
+def data_variables(stacked):
+    """
+    Returns the names of the data variables of stacked time steps, i.e. the time-dependent variables without the
+    time variable and its bounds.
+
+    Args:
+        stacked (dict): variable name -> stacked time steps (see read_time_steps())
+
+    Returns:
+        list: names of the data variables
+    """
+    return [name for name in stacked if name not in TIME_VARIABLES]
+
+
+def deaccumulate_data(stacked):
+    """
+    Converts the accumulated data of the forecast hours 00 .. break_hour into hourly data.
+
+    The hourly values are the differences of consecutive hours (t_i - t_i-1) computed in one NumPy operation on the
+    stacked time steps. The first hour (00) is kept as it is. Missing values in one of the two hours lead to a missing
+    value (like cdo sub). Only the data variables are converted (see data_variables()), time and its bounds are kept.
+
+    Args:
+        stacked (dict): variable name -> time steps 00, 01, .. (see search_data())
+
+    Returns:
+        dict: variable name -> hourly data of the time-dependent variables
+    """
+    for name in data_variables(stacked):
+        accumulated = stacked[name]
+        stacked[name] = np.ma.concatenate([accumulated[:1], accumulated[1:] - accumulated[:-1]])
+    print("Deaccumulated hours: {0}".format(len(stacked["time"])))
+    return stacked
+
+
+@netcdf_locked
+def read_time_steps(in_files):
+    """
+    Reads the time-dependent variables of all given files and stacks them along the time axis (in the given order).
+    Time is the first (record) dimension of all time-dependent variables.
+
+    Args:
+        in_files (list): netCDF-files with the same variables (e.g. the forecast hours of one model run)
+
+    Returns:
+        dict: variable name -> stacked (masked) array
+    """
+    parts = {}
+    for in_file in in_files:
+        with Dataset(in_file, "r") as nc_file:
+            for name, var in nc_file.variables.items():
+                if "time" in var.dimensions:
+                    parts.setdefault(name, []).append(var[:])
+    return {name: np.ma.concatenate(parts[name]) for name in parts}
+
+
+def concatenate_time_steps(pieces):
+    """
+    Concatenates the stacked time steps of several pieces (see read_time_steps()) along the time axis.
+
+    Only the variables of all pieces are concatenated: the time bounds that e.g. only the missing file carries are
+    left out. A data variable that is missing in some of the pieces can't be filled and raises an error.
+
+    Args:
+        pieces (list): dictionaries variable name -> stacked array, in the order of the time steps
+
+    Returns:
+        dict: variable name -> stacked array of all pieces
+
+    Raises:
+        ValueError: a data variable is not part of all pieces
+    """
+    names = set(pieces[0]).intersection(*pieces[1:])
+    incomplete = [name for name in data_variables(set().union(*pieces)) if name not in names]
+    if incomplete:
+        raise ValueError("%{0}: The variables {1} are not part of all time steps (e.g. the missing file does not fit "
+                         "the data).".format(concatenate_time_steps.__name__, ", ".join(sorted(incomplete))))
+    return {name: np.ma.concatenate([piece[name] for piece in pieces]) for name in pieces[0] if name in names}
+
+
+# missing files that were already read by this rank: path -> time-dependent variables (see read_time_steps())
+MISSING_CACHE = {}
+
+
+def missing_time_steps(missing_file, hours):
+    """
+    Creates the placeholders for the given forecast hours in memory.
+
+    The missing file (<input>/missing/<VAR>.missing, see create_missing.py) is read only once per rank. Its values are
+    repeated for every hour and the time variable gets the forecast hour as value.
+
+    Args:
+        missing_file (str): file with missing values of the variable
+        hours (list): forecast hours (int) that are not available
+
+    Returns:
+        dict: variable name -> stacked placeholders (see read_time_steps())
+    """
+    if missing_file not in MISSING_CACHE:
+        MISSING_CACHE[missing_file] = read_time_steps([missing_file])
+    missing = MISSING_CACHE[missing_file]
+    stacked = {}
+    for name, data in missing.items():
+        if name == "time":
+            stacked[name] = np.array(hours, dtype=data.dtype)
         else:
-            high_file = tempdir + "/" + hour
-            low_file = tempdir + "/" + hours[index]
-            out_file = tempdir + "/" + hour +".out"
-            print("t_i+1: {0}\n t_i: {1}\n out: {2}".format(high_file, low_file, out_file))
-            shell_args = "cdo sub {0} {1} {2}".format(high_file, low_file, out_file)
-            print("Command: '{0}''".format(shell_args))
-            term_shell(shell_args, "Failed converting to hourly data", False)
-        in_files = in_files + out_file + " "
-        index = index + 1
-    print("This are the files that will be merged: {0}".format(in_files))
-    return in_files
-
-
-def search_data(hours, tempdir):
-    in_files = " "
-    for hour in hours:
-        out_file = tempdir + "/" + hour
-        in_files = in_files + out_file + " "
-    print("This are the files that will be merged: {0}".format(in_files))
-    return in_files
+            stacked[name] = np.ma.concatenate([data[:1]] * len(hours))
+    print("INFO: Added {0} as missing values".format(hours))
+    return stacked
 
 
-def build_missing_data(model_run, existing_hours, max_hour, tempdir, missing_file, DEACUMMULATE):
-    in_files = " "
-    # check if data is available for time > 21, rewrite hours then...
-    hours_24 = [str(h).zfill(2)+".nc" for h in range(21, 25)]
-    if existing_hours[-1] in hours_24:
-        max_hour = 24
-        hours = [str(h).zfill(2)+".nc" for h in range(24, -1,-1)]  # ["24.nc", "23.nc", .., 00.nc]
-    if DEACUMMULATE:
-        # check until which time data is available, starting from zero.
-        # Until that time data can be used and deacummulated, afterwards missing data is needed regardles if data is available
-        possible_hours = [str(h).zfill(2) for h in range(0, (max_hour+1))] # 00, 01, 02, ..., max_hour
-        break_hour = -1
-        for hour in possible_hours:
-            if hour+".nc" not in existing_hours:
-                # hour is the position where data isn't available anymore
-                # therefore hour -1 is the position where data is still available
-                # break_hour is hour -1
-                break
-            break_hour = break_hour + 1
-        if break_hour > -1:
-            available_hours = [str(h).zfill(2)+".nc" for h in range((break_hour), -1,-1)]
-            in_files = deaccumulate_data(available_hours, break_hour, tempdir)
-        not_available_hours = [str(h).zfill(2) for h in range(max_hour, (break_hour),-1)]
-        for hour in not_available_hours:
-            shell_args = "ncap2 -s 'time+={3}-time' -s 'time@units=\"hours since {0}\"' {1} {2}/{3}.nc" \
-                     .format(model_run.strftime("%Y-%m-%d %H:00:00"), missing_file, tempdir, hour)
-            print('MISSING_file_Debug: Shell Arg is:{term_shell_cmd}'.format(term_shell_cmd=shell_args))   
-            term_shell(shell_args, "changing time@units in missing file failed.", False)
-            #    print("INFO: Added " + hour + " as missing value")
-            #    print("DEBUG: changed time@units in missing file")
-            out_file = tempdir + "/" + hour+ ".nc"
-            in_files = in_files + out_file + " "
-            print('MISSING_file_Debug:In_files is:{in_files}'.format(in_files=in_files))   
+def search_data(hours, loaded):
+    """
+    Stacks the given forecast hours.
+
+    Args:
+        hours (list): forecast hours (e.g. ["24.nc", "23.nc", .., "00.nc"])
+        loaded (dict): forecast hour -> time step (see build_data())
+
+    Returns:
+        dict: variable name -> stacked time steps in the order of the forecast hours (see read_time_steps())
+    """
+    return concatenate_time_steps([loaded[hour] for hour in sorted(hours)])
 
+
+def run_plan(plan, loaded, missing_file, DEACUMMULATE):
+    """
+    Builds the time steps 00 .. max_hour of one model run and member as planned (see planner.plan_hours()). Missing
+    hours are filled with placeholders from the missing file (see missing_time_steps()).
+
+    Args:
+        plan (planner.MergePlan): strategy, last forecast hour, last deaccumulated hour and hours to fill
+        loaded (dict): forecast hour (e.g. "07.nc") -> time step
+        missing_file (str): file with missing values of the variable
+        DEACUMMULATE: convert the accumulated data into hourly data
+
+    Returns:
+        dict: variable name -> stacked time steps (see read_time_steps())
+    """
+    hours = [str(h).zfill(2)+".nc" for h in range(0, plan.max_hour + 1)]  # ["00.nc", "01.nc", .., max_hour]
+    if plan.strategy == "full":
+        if DEACUMMULATE:
+            return deaccumulate_data(search_data(hours, loaded))
+        return search_data(hours, loaded)
+    pieces = []
+    if DEACUMMULATE:
+        # until break_hour the data can be used and deacummulated, afterwards missing data is needed
+        if plan.break_hour > -1:
+            pieces.append(deaccumulate_data(search_data(hours[:plan.break_hour + 1], loaded)))
+        if plan.missing_hours:
+            pieces.append(missing_time_steps(missing_file, plan.missing_hours))
     else:
         for hour in hours:
-            if hour not in existing_hours:
-                # create missing datafile to use as placeholder
-                shell_args = "ncap2 -s 'time+={3}-time' -s 'time@units=\"hours since {0}\"' {1} {2}/{3}.nc" \
-                        .format(model_run.strftime("%Y-%m-%d %H:00:00"), missing_file, tempdir, hour)
-                print('MISSING_file_Debug:{term_shell_cmd}'.format(term_shell_cmd=shell_args))  
-                term_shell(shell_args, "changing time@units in missing file failed.", False)
-                #    print("INFO: Added " + hour + " as missing value")
-                #    print("DEBUG: changed time@units in missing file")
-            out_file = tempdir + "/" + hour
-            in_files = in_files + out_file + " "
-    return in_files
+            if int(hour.split(".")[0]) in plan.missing_hours:
+                # use missing data as placeholder
+                pieces.append(missing_time_steps(missing_file, [int(hour.split(".")[0])]))
+            else:
+                pieces.append(loaded[hour])
+    return concatenate_time_steps(pieces)
+
+
+def stack_time_steps(model_run, loaded, missing_file, DEACUMMULATE, plan=None):
+    """
+    Stacks the forecast hours of one model run and member. If not all needed forecast hours are available, placeholders
+    with "missing values" are used instead (see run_plan()).
+
+    Args:
+        model_run (datetime): the model run we are looking at
+        loaded (dict): forecast hour (e.g. "07.nc") -> time step, i.e. variable name -> array with one time step
+        missing_file (str): file with missing values of the variable
+        DEACUMMULATE: convert the accumulated data into hourly data
+        plan (planner.MergePlan): strategy chosen by the master (see helper.merge_tasks_indexer()), None: it is chosen
+            from the loaded hours
+
+    Returns:
+        dict: variable name -> stacked time steps 00 .. 21/24 (see read_time_steps())
+    """
+    if plan is None:
+        plan = plan_hours([int(hour.split(".")[0]) for hour in loaded], DEACUMMULATE)
+    if plan.strategy != "full":
+        print("INFO: {0} of model run {1}: hours 00..{2:02d}, {3} filled with missing values"
+              .format(plan.strategy, model_run.strftime("%Y%m%d-%H"), plan.max_hour, len(plan.missing_hours)))
+    return run_plan(plan, loaded, missing_file, DEACUMMULATE)
 
 
 def build_data(model_run, member, existing_hours, tempdir, source_path, COMPRESS_LEVEL, cosmo_grid_des, tar_grid_des,
                missing_file, DEACUMMULATE, RENAME_VAR, old_name, new_name, CHANGE_UNITS, units, CHANGE_LONG_NAME,
-               long_name, REMAPPED, remapped_dir, NATIVE, native_dir):
+               long_name, REMAPPED, remapped_dir, NATIVE, native_dir, weights=None, hour_files=None, profile=None,
+               plan=None):
     """
     This function first checks if all needed forecast_hours are available. If this is not the case the data will be deleted and
-    a file that contains "missing values" is used as placeholder.
-    If all needed files are available, the files are merged to one big file containing all forecast_hours for that model_run.
+    a placeholder with "missing values" is used instead.
+    All forecast hours are stacked in memory and written to one big file containing all forecast_hours for that model_run.
     Dependig on the variable also a conversion to hourly data is done and file-attributes are adjusted.
     Note that intermediate files are stored temporary in tempdir that is cleaned with the remove_data-function
     (see below).
@@ -174,89 +304,118 @@ def build_data(model_run, member, existing_hours, tempdir, source_path, COMPRESS
     @param existing_hours: describes all forecast hours that exist in our data set
     @param tempdir: this is the temporary directory this script is working in
     @param source_path: the path where the data comes from and the created file need to be stored
-    @param COMPRESS_LEVEL: ?
+    @param COMPRESS_LEVEL: deflate level of the processed files (0: no compression)
     @param cosmo_grid_des: CDO grid decription for data on COSMO's native grid
     @param tar_grid_des: CDO grid description for the target grid (onto which data is remapped)
+    @param weights: file with the weights for remapping (see remapper.weights_file()), None: remap with cdo remapcon
+    @param hour_files: forecast hour -> path of the time step (see fragment_hours()), None: the hours are in tempdir
+    @param profile: chunking and compression of the processed files (see profiles.parse_profile()), None: deflate at
+    COMPRESS_LEVEL
+    @param plan: merge strategy of the model run and member (see planner.plan_hours()), None: chosen from existing_hours
     """
-    max_hour = 24
-    clean = False # TODO: check if it is really needed and if so change it to the correct behaviour (needed for term_shell())
-    hours = [str(h).zfill(2)+".nc" for h in range(24, -1,-1)]  # ["24.nc", "23.nc", .., 00.nc]
-    if set(hours) != set(existing_hours):
-        # There are not 24 forecast_hours available. Either only 21 are available or something is wrong
-        hours = [str(h).zfill(2)+".nc" for h in range(21, -1,-1)]  # ["21.nc", "20.nc", .., 00.nc]
-        max_hour = 21
-    if set(hours) != set(existing_hours):
-        # Some data is not available. It will be filled with missing values
-        in_files = build_missing_data(model_run, existing_hours, max_hour, tempdir, missing_file, DEACUMMULATE)
-    else:
-        # All needed data is available and will be processed here:
-        if DEACUMMULATE:
-            in_files = deaccumulate_data(hours, max_hour, tempdir)
-        else:
-            in_files = search_data(hours, tempdir)
+    hour_files = hour_files or {hour: tempdir + "/" + hour for hour in existing_hours}
+    loaded = {hour: read_time_steps([hour_files[hour]]) for hour in existing_hours}
+    stacked = stack_time_steps(model_run, loaded, missing_file, DEACUMMULATE, plan)
 
-    # Merge all given files
-    step_file = "{0}/step_1.nc".format(tempdir)
-    shell_args = "cdo{0}-s -mergetime {1} {2}".format(COMPRESS_LEVEL, in_files, step_file)
-    term_shell(shell_args, "Failed merging time steps", clean)
-    print("INFO: Merging       ...ok")
+    # the structure of the outputs is taken from an available hour or the missing file
+    template_file = hour_files[existing_hours[0]] if existing_hours else missing_file
+    with open_dataset(template_file, "r") as template:  # only used by the locked writers (see nclock.py)
+        write_processed(model_run, member, template, stacked, tempdir, source_path, cosmo_grid_des, tar_grid_des,
+                        RENAME_VAR, old_name, new_name, CHANGE_UNITS, units, CHANGE_LONG_NAME, long_name,
+                        REMAPPED, remapped_dir, NATIVE, native_dir, weights, profile or default_profile(COMPRESS_LEVEL))
 
-    variable = old_name
 
+def write_processed(model_run, member, template, stacked, tempdir, source_path, cosmo_grid_des, tar_grid_des,
+                    RENAME_VAR, old_name, new_name, CHANGE_UNITS, units, CHANGE_LONG_NAME, long_name,
+                    REMAPPED, remapped_dir, NATIVE, native_dir, weights=None, profile=None):
+    """
+    Writes the stacked time steps of one model run and member as processed:YYYYMMDDHH.mEE.nc (remapped and/or on the
+    native grid). The variable is renamed and its units and long_name are changed while the files are written.
+    @param template: open netCDF4.Dataset with one time step on the native grid (gives the structure of the outputs)
+    @param stacked: variable name -> stacked time steps (see stack_time_steps())
+    @param tempdir: temporary directory for the merged file (only used for cdo remapcon, i.e. weights is None)
+    @param profile: chunking and compression of the processed files (see profiles.parse_profile()), the merged file in
+    tempdir is not compressed
+    (see build_data() for the other parameters)
+    """
+    step_file = "{0}/step_1.nc".format(tempdir)
+    profile = profile or default_profile()
+    attributes = {"time": {"units": "hours since {0}".format(model_run.strftime("%Y-%m-%d %H:%M:%S"))}}
+    attributes[old_name] = {}
+    if CHANGE_UNITS:
+        attributes[old_name]["units"] = units
+    if CHANGE_LONG_NAME:
+        attributes[old_name]["long_name"] = long_name
+    renames = {}
     if RENAME_VAR:
-        # rename the variable name
-        step_1_file = "{0}/step_2.nc".format(tempdir)
-        shell_args = "cdo chname,{old},{new} {in_file} {out_file}"\
-                     .format(old = old_name, new=new_name, in_file = step_file, out_file=step_1_file)
-        term_shell(shell_args, "Failed renaming variable", clean)
-        step_file = step_1_file
-        variable = new_name
-
-    if CHANGE_UNITS and CHANGE_LONG_NAME:
-        # change both units and long_name of variable
-        step_1_file = "{0}/step_3.nc".format(tempdir) # create the name of the datafile that holds all information from before
-        shell_args = "ncap2 -s '{variable}@units=\"{units}\"' -s '{variable}@long_name=\"{long_name}\"' {in_file} {out_file}"\
-                     .format(units = units, variable = variable, long_name = long_name, in_file = step_file, out_file = step_1_file)
-        term_shell(shell_args, "Failed adapting units and long_name", clean)
-        step_file = step_1_file
-        print("INFO: Adaption       ...ok")
-    elif CHANGE_UNITS:
-        # change only units of variable
-        step_1_file = "{0}/step_3.nc".format(tempdir) # create the name of the datafile that holds all information from before
-        shell_args = "ncap2 -s '{variable}@units=\"{units}\"' {in_file} {out_file}"\
-                     .format(units = units, variable = variable, in_file = step_file, out_file = step_1_file)
-        term_shell(shell_args, "Failed adapting units", clean)
-        step_file = step_1_file
-        print("INFO: Adaption       ...ok")
-    elif CHANGE_LONG_NAME:
-        # change only long_name of variable
-        step_1_file = "{0}/step_3.nc".format(tempdir) # create the name of the datafile that holds all information from before
-        shell_args = "ncap2 -s '{variable}@long_name=\"{long_name}\"' {in_file} {out_file}"\
-                     .format(variable = variable, long_name = long_name, in_file = step_file, out_file = step_1_file)
-        term_shell(shell_args, "Failed adapting long_name", clean)
-        step_file = step_1_file
+        renames[old_name] = new_name
+    if REMAPPED and weights is None:  # cdo remapcon works on the merged file
+        write_like(template, step_file, stacked, attributes, renames)
+    print("INFO: Merging       ...ok")
+    if RENAME_VAR or CHANGE_UNITS or CHANGE_LONG_NAME:
         print("INFO: Adaption       ...ok")
 
     # Path for remapped and native
+    # The outputs are written to a hidden file first and renamed when complete, so processed:*.nc is never half-written
 
     if REMAPPED:
         # Finally, remap the data (TODO: make compression level flexible, not relying on default of remap_data)
         # remap_method=conservative should be chosen for precipitation data
         path = "{0}/{1}".format(source_path, remapped_dir)
-        # TODO: Should be in main.py!
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        # TODO: Should be in main.py! (several members of the same variable can be processed at the same time)
+        os.makedirs(path, exist_ok=True)
 
         outfile = "{0}/processed:{1}.m{2}.nc".format(path, model_run.strftime("%Y%m%d%H"), member)
-        _ = remap_data(step_file, cosmo_grid_des, outfile, tar_grid_des, remap_method="conservative")
+        if weights is not None:
+            # all time steps are remapped at once with the precomputed weights
+            write_remapped(template, partial_file(outfile), stacked, read_weights(weights), tar_grid_des,
+                           attributes, renames, profile)
+        elif profile.chunks is None and not profile.shuffle:  # e.g. the default profile : cdo -z zip_<level> is enough
+            _ = remap_data(step_file, cosmo_grid_des, partial_file(outfile), tar_grid_des, profile.level,
+                           remap_method="conservative")
+        else:  # cdo sets neither the chunking nor the shuffle filter : the remapped file is rewritten with the profile
+            remapped_file = "{0}/step_2.nc".format(tempdir)
+            _ = remap_data(step_file, cosmo_grid_des, remapped_file, tar_grid_des, 0, remap_method="conservative")
+            rechunk_data(remapped_file, partial_file(outfile), nccopy_options(profile))
+            os.remove(remapped_file)
+        os.replace(partial_file(outfile), outfile)
 
     if NATIVE:
         path = "{0}/{1}".format(source_path, native_dir)
-        # TODO: Should be in main.py! -> Can be replaced by os.makedirs(path, exist_ok=True)
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        # TODO: Should be in main.py! (several members of the same variable can be processed at the same time)
+        os.makedirs(path, exist_ok=True)
         outfile = "{0}/processed:{1}.m{2}.nc".format(path, model_run.strftime("%Y%m%d%H"), member)
-        _ = modify_native_data(step_file, outfile)
+        # the merged time steps are written directly with inverted latitudes and (time, rlon, rlat) ordering
+        write_native(template, partial_file(outfile), stacked, attributes, renames, profile)
+        os.replace(partial_file(outfile), outfile)
+
+
+def partial_file(outfile):
+    """
+    Returns the name of the hidden file the output is written to before it is renamed to outfile.
+    The name does not match processed:*.nc, so half-written files are never picked up by the import.
+    @param outfile: name of the final output file
+    @return: name of the partial file in the same directory
+    """
+    return "{0}/.partial-{1}".format(os.path.dirname(outfile), os.path.basename(outfile))
+
+
+def processed_files(model_run, member, source_path, REMAPPED, remapped_dir, NATIVE, native_dir):
+    """
+    Returns the output files build_data() creates for the given model_run and member.
+    @param model_run: datetime object specifying the model_run we are looking at
+    @param member: specifying the member we are looking at
+    @param source_path: the path of the variable the files are stored in
+    @return: list of the remapped and/or native output files
+    """
+    outfiles = []
+    if REMAPPED:
+        outfiles.append("{0}/{1}/processed:{2}.m{3}.nc".format(source_path, remapped_dir,
+                                                              model_run.strftime("%Y%m%d%H"), member))
+    if NATIVE:
+        outfiles.append("{0}/{1}/processed:{2}.m{3}.nc".format(source_path, native_dir,
+                                                              model_run.strftime("%Y%m%d%H"), member))
+    return outfiles
 
 
 def build_data_old(a_time, e_mem, exis, missing, tempdir, source_path, COMPRESS_LEVEL):
@@ -295,7 +454,7 @@ def build_data_old(a_time, e_mem, exis, missing, tempdir, source_path, COMPRESS_
     print("INFO: Merging       ...ok")
 
 #remove_data(actual_time, member, relative_tempdir, relative_var_dir)  # remove all datafiles that where used to build the file above
-def remove_data(a_time: datetime, e_mem, source_path, tempdir):
+def remove_data(a_time: datetime, e_mem, source_path, tempdir, fragments=None):
     """
     All specified files where removed.
 
@@ -306,11 +465,17 @@ def remove_data(a_time: datetime, e_mem, source_path, tempdir):
     Args:
         a_time (datetime): specifies the time attribute of the files that should be deleted
         e_mem (str): specifies the member, which files should be removed
+        tempdir (str): temporary directory of the merging (None if there is none to remove)
+        fragments (list): the time steps to remove (see fragment_index()), None: search source_path
     """
-    for data_file in glob.glob("{0}/time:{1}.*.m{2}.nc".format(source_path, a_time.strftime("%Y%m%d-%H"), e_mem)):
-        os.remove(data_file)
+    if fragments is None:
+        fragments = glob.glob("{0}/time:{1}.*.m{2}.nc".format(source_path, a_time.strftime("%Y%m%d-%H"), e_mem))
+    for data_file in fragments:
+        if os.path.isfile(data_file):
+            os.remove(data_file)
     print("DEBUG: Files removed.")
-    shutil.rmtree(tempdir)
+    if tempdir is not None:
+        shutil.rmtree(tempdir)
     print("INFO: Removing      ...ok")
 
 
@@ -0,0 +1,50 @@
+"""
+Serialization of the in-process netCDF I/O of a rank.
+
+netCDF4-python releases the GIL while it calls the netCDF-C and HDF5 libraries, which are not thread-safe. The local
+workers of a rank (Local_Workers > 1 or Master_Works, see scheduler.py) are threads of one process, so two of them
+reading or writing netCDF-files at the same time crash the rank (segfaults, "NetCDF: HDF error"). Every in-process open,
+read, write and close of a netCDF-file therefore holds NETCDF_LOCK. The workers still overlap in the external tools
+(grib_filter, cdo, nccopy), in the decoding with ecCodes and in the NumPy work between the reads and writes.
+"""
+import threading
+from contextlib import contextmanager
+from functools import wraps
+from netCDF4 import Dataset
+
+# reentrant : the locked functions call each other (e.g. write_time_step() -> write_like())
+NETCDF_LOCK = threading.RLock()
+
+
+# ======================= List of functions ====================================== #
+
+
+def netcdf_locked(func):
+    """
+    Decorator for the functions that use netCDF4: the whole function runs while holding NETCDF_LOCK.
+    @param func: function that opens, reads or writes netCDF-files
+    @return: the wrapped function
+    """
+    @wraps(func)
+    def locked(*args, **kwargs):
+        with NETCDF_LOCK:
+            return func(*args, **kwargs)
+    return locked
+
+
+@contextmanager
+def open_dataset(*args, **kwargs):
+    """
+    Opens a netCDF4.Dataset that is kept open while other work is done (e.g. a template passed to the writers). Only
+    opening and closing hold NETCDF_LOCK, the file must only be used by locked functions in between.
+    @param args: arguments of netCDF4.Dataset
+    @param kwargs: keyword arguments of netCDF4.Dataset
+    @return: context manager giving the open netCDF4.Dataset
+    """
+    with NETCDF_LOCK:
+        dataset = Dataset(*args, **kwargs)
+    try:
+        yield dataset
+    finally:
+        with NETCDF_LOCK:
+            dataset.close()
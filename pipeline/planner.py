@@ -0,0 +1,113 @@
+"""
+Planning of the merge phase.
+
+Before the merge tasks are handed out, the master lists the time steps of every day and variable once and builds a
+dense availability bitmap over the 8 model runs x 20 members x 25 forecast hours. The merge strategy of every cell
+(model run, member) is chosen from the bitmap up front and sent along with the task, so the slaves only carry out the
+plan (see merger.stack_time_steps()):
+    full -- all forecast hours 00..24 or 00..21 are available
+    break -- deaccumulated variable: the hours up to break_hour are used, the rest is filled with missing values
+    fill -- the available hours are used as they are, every missing hour is filled with missing values
+    missing -- no hour can be used, the model run is filled with missing values only
+The bitmap of every day and variable is written as a gap report next to the processed data.
+"""
+import os
+from collections import namedtuple
+from datetime import timedelta
+import numpy as np
+
+NUM_RUNS = 8  # model runs per day (00, 03, .., 21)
+NUM_MEMBERS = 20  # members per model run (01, .., 20)
+NUM_HOURS = 25  # forecast hours per model run (00, .., 24)
+SHORT_HOUR = 21  # last forecast hour of the model runs with fewer forecast hours
+
+MergePlan = namedtuple("MergePlan", ["strategy", "max_hour", "break_hour", "missing_hours"])
+
+
+# ======================= List of functions ====================================== #
+
+
+def plan_hours(available_hours, deaccumulate):
+    """
+    Chooses the merge strategy of one model run and member (see module description).
+    @param available_hours: forecast hours (int) of the available time steps
+    @param deaccumulate: the variable is converted from accumulated into hourly data
+    @return: MergePlan with the strategy, the last forecast hour of the processed file, the last hour that is
+             deaccumulated (break strategy, -1: none) and the forecast hours that are filled with missing values
+    """
+    available = set(available_hours)
+    for max_hour in (NUM_HOURS - 1, SHORT_HOUR):
+        if available == set(range(0, max_hour + 1)):
+            return MergePlan("full", max_hour, max_hour, [])
+
+    # not all hours are there : the run is extended to 24 hours if any of the hours 21..24 is available
+    max_hour = SHORT_HOUR
+    if available and SHORT_HOUR <= max(available) <= NUM_HOURS - 1:
+        max_hour = NUM_HOURS - 1
+    if deaccumulate:
+        # the hours can be deaccumulated until the first missing hour, afterwards missing data is needed regardless
+        # if data is available
+        break_hour = -1
+        while break_hour < max_hour and break_hour + 1 in available:
+            break_hour = break_hour + 1
+        strategy = "break" if break_hour > -1 else "missing"
+        return MergePlan(strategy, max_hour, break_hour, list(range(break_hour + 1, max_hour + 1)))
+    missing_hours = [hour for hour in range(0, max_hour + 1) if hour not in available]
+    strategy = "fill" if len(missing_hours) <= max_hour else "missing"
+    return MergePlan(strategy, max_hour, -1, missing_hours)
+
+
+def availability_bitmap(index, first_run):
+    """
+    Builds the availability bitmap of one day and variable from the listing of its time steps.
+    @param index: (model run "YYYYmmdd-HH", member "EE") -> paths of the time steps (see merger.fragment_index())
+    @param first_run: datetime of the first model run of the day (00 UTC)
+    @return: boolean array (model run, member, forecast hour) of shape (8, 20, 25)
+    """
+    bitmap = np.zeros((NUM_RUNS, NUM_MEMBERS, NUM_HOURS), dtype=bool)
+    for run in range(0, NUM_RUNS):
+        model_run = (first_run + timedelta(hours=3 * run)).strftime("%Y%m%d-%H")
+        for member in range(0, NUM_MEMBERS):
+            for path in index.get((model_run, str(member + 1).zfill(2)), []):
+                hour = int(os.path.basename(path).split(".")[-3])  # time:YYYYMMDD-HH.FF.mEE.nc
+                if 0 <= hour < NUM_HOURS:
+                    bitmap[run, member, hour] = True
+    return bitmap
+
+
+def plan_bitmap(bitmap, deaccumulate):
+    """
+    Chooses the merge strategy of every model run and member of the bitmap.
+    @param bitmap: availability bitmap (see availability_bitmap())
+    @param deaccumulate: the variable is converted from accumulated into hourly data
+    @return: dictionary (run index, member index) -> MergePlan
+    """
+    return {(run, member): plan_hours(np.flatnonzero(bitmap[run, member]).tolist(), deaccumulate)
+            for run in range(0, NUM_RUNS) for member in range(0, NUM_MEMBERS)}
+
+
+def write_gap_report(report_file, bitmap, plans, title):
+    """
+    Writes the availability bitmap with the chosen strategies as a text file: one line per model run and member with
+    one character per forecast hour (X: available, .: missing).
+    @param report_file: path of the report
+    @param bitmap: availability bitmap (see availability_bitmap())
+    @param plans: strategies of the cells (see plan_bitmap())
+    @param title: first line of the report (e.g. the day and the variable)
+    """
+    counts = {}
+    lines = ["# {0}".format(title),
+             "# run member hours 00..{0} (X: available, .: missing) strategy".format(NUM_HOURS - 1)]
+    for run in range(0, NUM_RUNS):
+        for member in range(0, NUM_MEMBERS):
+            plan = plans[(run, member)]
+            counts[plan.strategy] = counts.get(plan.strategy, 0) + 1
+            lines.append("{0:02d} {1:02d} {2} {3}".format(3 * run, member + 1,
+                                                          "".join("X" if available else "." for available
+                                                                  in bitmap[run, member]), plan.strategy))
+    lines.append("# {0} of {1} time steps available, {2}".format(
+        int(bitmap.sum()), bitmap.size, ", ".join("{0}: {1}".format(name, num) for name, num in sorted(counts.items()))))
+    temp_file = "{0}/.partial-{1}".format(os.path.dirname(report_file), os.path.basename(report_file))
+    with open(temp_file, "w") as report:
+        report.write("\n".join(lines) + "\n")
+    os.replace(temp_file, report_file)
@@ -1,17 +1,21 @@
 from mpi4py import MPI
 import sys
-import subprocess
 import logging
 import time
 import os
 import shutil
 import glob
 from datetime import datetime, timedelta
-from netCDF4 import Dataset
+from netCDF4 import Dataset, num2date
 import numpy as np
 
 from exception import MainError
 from exception import SlaveError
+from executor import run_command
+from nclock import netcdf_locked
+from profiles import default_profile
+from profiles import needs_netcdf4
+from profiles import variable_options
 
 # ====================== Shared tools across all scripts ========================= #
 # ini. MPI
@@ -25,6 +29,8 @@ if my_rank == 0:  # node is master
     logger = logging.getLogger(__file__)
     logger.addHandler(logging.StreamHandler(sys.stdout))
 
+SCRATCH_RESERVE = 256 * 1024 ** 2  # bytes that are always left free in the scratch (see scratch_dir())
+
 # ======================= List of functions ====================================== #
 
 
@@ -92,6 +98,20 @@ def get_forecast_hour(filename):
         return int(os.path.basename(filename).split(".")[1])
 
 
+def get_member(filename):
+    """
+    This function returns the ensemble member of the given file using its name.
+    The member is stored in the second last component:
+    cdeYYYYMMDD.HH.mEE.grib2
+    @param filename: specifies the filename where the member should be extracted from
+    @return: the member extracted of the filename ("01", ..), None if the name has no member component
+    """
+    for component in reversed(os.path.basename(filename).split(".")):
+        if len(component) > 1 and component[0] == "m" and component[1:].isdigit():
+            return component[1:]
+    return None
+
+
 def split_to_variable(in_file, relative_filter_file):
     """
     Splits the in_file into its variables using the relative_filter_file
@@ -99,8 +119,8 @@ def split_to_variable(in_file, relative_filter_file):
     @param in_file: file-name of the file that should be splitted into its variables
     """
     # TODO : @amirpasha : this function does not work like this on the juwels!
-    ret_code = subprocess.call(["grib_filter", relative_filter_file, in_file])
-    if ret_code != 0:
+    record = run_command("grib_filter {0} {1}".format(relative_filter_file, in_file), "split")
+    if record["exit_code"] != 0:
         raise SlaveError(function="split_to_variable()",
                          message="Something went wrong while splitting into the variables.")
 
@@ -133,12 +153,35 @@ def define_out_file_path(relative_destination_dir, v_name):
     return out_name
 
 
+def scratch_dir(scratch_root, fallback_root, name, needed_bytes=0):
+    """
+    Defines the directory for intermediate files. It is placed in the scratch (e.g. node-local SSD or /dev/shm) if one
+    is given and has enough free space left, otherwise next to the outputs in the destination.
+    @param scratch_root: directory for intermediate files ("" or None: no scratch)
+    @param fallback_root: directory used instead of the scratch (e.g. the destination directory)
+    @param name: relative path of the directory (e.g. <day>/split_<input file>)
+    @param needed_bytes: expected size of the intermediate files
+    @return: path of the directory (not created yet)
+    """
+    if scratch_root:
+        try:
+            os.makedirs(scratch_root, exist_ok=True)
+            free = shutil.disk_usage(scratch_root).free
+            if free >= needed_bytes + SCRATCH_RESERVE:
+                return scratch_root + "/" + name
+            print("WARNING: Scratch {0} is full ({1} bytes free) -> {2} is used".format(scratch_root, free,
+                                                                                    fallback_root))
+        except OSError as err:
+            print("WARNING: Scratch {0} is not usable ({1}) -> {2} is used".format(scratch_root, err, fallback_root))
+    return fallback_root + "/" + name
+
+
 def grib_to_netcdf(infile: str, outfile: str, compress_lvl: int = 6):
     """
     Converts grib-files to netCDF-data. If compress_lvl is given, zip-compression is performed as well.
     :param infile: input grib-file
     :param outfile: target netCDF-file (to be created)
-    :param compress_lvl: level for zip-compression (must be within 1 and 9)
+    :param compress_lvl: level for zip-compression (must be within 0 and 9, 0: no compression)
     """
     method = grib_to_netcdf.__name__
 
@@ -153,14 +196,15 @@ def grib_to_netcdf(infile: str, outfile: str, compress_lvl: int = 6):
                               .format(method, outfile))
 
     compress_lvl = int(compress_lvl)
-    if not 1 <= compress_lvl <= 9:
-        raise ValueError("%{0}: Invalid compression level '{1}' chosen. Value must be within 1 and 9."
+    if not 0 <= compress_lvl <= 9:
+        raise ValueError("%{0}: Invalid compression level '{1}' chosen. Value must be within 0 and 9."
                          .format(method, compress_lvl))
 
     # Create cdo-command for conversion..
-    args = "cdo -O --reduce_dim -s -f nc4 -z zip_{0:d} copy {1} {2}".format(compress_lvl, infile, outfile)
+    zip_str = " -z zip_{0:d}".format(compress_lvl) if compress_lvl > 0 else ""
+    args = "cdo -O --reduce_dim -s -f nc4{0} copy {1} {2}".format(zip_str, infile, outfile)
     # ... run it
-    term_shell(args, "%{0}: Failed conversion grib->netCDF for file '{1}'.".format(method, infile), True)
+    term_shell(args, "%{0}: Failed conversion grib->netCDF for file '{1}'.".format(method, infile), True, "convert")
 
     return True
 
@@ -178,7 +222,7 @@ def remap_data(infile: str, ingrid: str, outfile: str, outgrid: str, compress_lv
     :param ingrid: a CDO grid description for the input data
     :param outfile: name of output netCDF-file
     :param outgrid: a CDO grid description for the target (output) data
-    :param compress_lvl: deflate compression level (must be between 1 and 9)
+    :param compress_lvl: deflate compression level (must be between 0 and 9, 0: no compression)
     :param remap_method: CDO-method for remapping (e.g. "bilinear", "nearest_neighbor", "conservative" etc.)
     :return status: True in case of success
     """
@@ -193,8 +237,8 @@ def remap_data(infile: str, ingrid: str, outfile: str, outgrid: str, compress_lv
         raise FileNotFoundError("%{0}: Could not find description file '{1}' for target grid".format(method, outgrid))
 
     compress_lvl = int(compress_lvl)
-    if not 1 <= compress_lvl <= 9:
-        raise ValueError("%{0}: Invalid compression level '{1}' chosen. Value must be within 1 and 9."
+    if not 0 <= compress_lvl <= 9:
+        raise ValueError("%{0}: Invalid compression level '{1}' chosen. Value must be within 0 and 9."
                          .format(method, compress_lvl))
 
     # append outfile path by netcdf-extension if required
@@ -215,15 +259,31 @@ def remap_data(infile: str, ingrid: str, outfile: str, outgrid: str, compress_lv
     #       .format(compress_lvl, remap_str, outgrid, ingrid, infile, outfile) #TODO original run on 2017/01
     #args = "cdo -L -O --reduce_dim -s -f nc -z zip_{0:d} {1},{2} -setgrid,{3} -setctomiss,-999.9 {4} {5}"\
     #       .format(compress_lvl, remap_str, outgrid, ingrid, infile, outfile) #TODO run on 2017/02
-    args = "cdo -L -O --reduce_dim -s -f nc {1},{2} -setgrid,{3} -setctomiss,-999.9 {4} {5}"\
-           .format(compress_lvl, remap_str, outgrid, ingrid, infile, outfile) #TODO no zip is carried out as not supported with netCDF
+    # netCDF (classic) does not support zip : the compressed outputs are written as netCDF4-classic
+    format_str = "-f nc4c -z zip_{0:d}".format(compress_lvl) if compress_lvl > 0 else "-f nc"
+    args = "cdo -L -O --reduce_dim -s {0} {1},{2} -setgrid,{3} -setctomiss,-999.9 {4} {5}"\
+           .format(format_str, remap_str, outgrid, ingrid, infile, outfile)
     # ... run it
     term_shell(args, "%{0}: Failed remapping from '{0}' to '{1}' with grid description '{2}'"
-                     .format(method, infile, outfile, outgrid), True)
+                     .format(method, infile, outfile, outgrid), True, "remap")
 
     return True
 
 
+def rechunk_data(infile: str, outfile: str, options: str):
+    """
+    Rewrites a netCDF-file with other chunking and compression (nccopy, see profiles.nccopy_options()).
+    :param infile: input netCDF-file
+    :param outfile: name of output netCDF-file
+    :param options: options of nccopy (-k, -d, -s, -c)
+    """
+    method = rechunk_data.__name__
+    if not os.path.isfile(infile):
+        raise FileNotFoundError("%{0}: Could not find input file '{1}'.".format(method, infile))
+    args = "nccopy {0} {1} {2}".format(options, infile, outfile)
+    term_shell(args, "%{0}: Failed rewriting '{1}' to '{2}'".format(method, infile, outfile), True, "rechunk")
+
+
 def remapfunc_cdo(remap_method: str):
     """
     Chosse remapping operator of CDO accoring to method. Known methods: "bilinear", "bicubic", "nearest_neighbor",
@@ -246,43 +306,67 @@ def remapfunc_cdo(remap_method: str):
                          .format(method, remap_method, ", ".join(known_remap.keys())))
 
 
-def modify_native_data(infile: str, outfile: str, compress_lvl: int = 6):
+@netcdf_locked
+def write_native(template, out_file, time_dependent, attributes=None, renames=None, profile=None):
     """
-    Modify existing netCDF-datfile with (native COSMO-)data to be ingestable to Rasdaman.
-    :param infile: input netCDF-file with COSMO-data on native grid
-    :param outfile: name of output netCDF-file
-    :param compress_lvl: deflate compression level (must be between 1 and 9)
-    :return status: True in case of success
+    Writes the time steps on the native COSMO grid in the layout Rasdaman ingests: the latitude axis is inverted and
+    the dimensions are ordered (time, rlon, rlat). This gives the same file as cdo invertlat + ncpdq --rdr=time,rlon,rlat
+    in a single write (see write_like() for the parameters).
+    @param template: open netCDF4.Dataset on the native grid
+    @param out_file: name of the netCDF-file to be created
+    @param time_dependent: dictionary variable name -> array of all time steps
+    @param attributes: dictionary variable name -> dictionary of attributes that are set on top of the copied ones
+    @param renames: dictionary variable name -> name of the variable in out_file
+    @param profile: chunking and compression of the fields (see profiles.parse_profile(), default: uncompressed)
     """
-    method = modify_native_data.__name__
-
-    # sanity checks
-    if not os.path.isfile(infile):
-        raise FileNotFoundError("%{0}: Could not find input file '{1}'.".format(method, infile))
-
-    args = ["cdo -O --reduce_dim -s invertlat {1} {2}".format(compress_lvl, infile, outfile),
-            "ncpdq -O --rdr=time,rlon,rlat {0} {1}".format(outfile, outfile)]
-
-    # invert the latitude axis with CDO
-    term_shell(args[0], "%{0}: Failed inversion of latitude axis with file '{1}'".format(method, infile), True)
-    # ... and swap dimension order with ncpdq
-    term_shell(args[1], "%{0}: Failed swapping rlat and rlon coordinate axis with file '{1}'".format(method, outfile),
-               True)
-
-    return True
-
-
-def term_shell(shell_args: str, err_message: str, clean: bool):
+    attributes = attributes or {}
+    renames = renames or {}
+    profile = profile or default_profile()
+    out_format = template.data_model
+    if needs_netcdf4(profile) and not out_format.startswith("NETCDF4"):
+        out_format = "NETCDF4_CLASSIC"  # netCDF (classic) does not support zip and chunking
+    with Dataset(out_file, "w", format=out_format) as out:
+        out.setncatts({name: template.getncattr(name) for name in template.ncattrs()})
+        for name, dimension in template.dimensions.items():
+            out.createDimension(name, None if dimension.isunlimited() else len(dimension))
+        for name, in_var in template.variables.items():
+            dimensions = list(in_var.dimensions)
+            if "rlat" in dimensions and "rlon" in dimensions:
+                dimensions = [dim for dim in dimensions if dim not in ("rlat", "rlon")] + ["rlon", "rlat"]
+            fill_value = in_var.getncattr("_FillValue") if "_FillValue" in in_var.ncattrs() else None
+            data = None
+            if len(in_var.dimensions) > 0:
+                data = time_dependent[name] if name in time_dependent else in_var[:]
+                if "rlat" in in_var.dimensions:
+                    flip = [slice(None)] * len(in_var.dimensions)
+                    flip[in_var.dimensions.index("rlat")] = slice(None, None, -1)
+                    data = data[tuple(flip)]  # invertlat
+                data = np.ma.transpose(data, [in_var.dimensions.index(dim) for dim in dimensions])
+            options = variable_options(profile, dimensions, np.shape(data))
+            out_var = out.createVariable(renames.get(name, name), in_var.datatype, dimensions, fill_value=fill_value,
+                                         **options)
+            out_var.setncatts({attr: in_var.getncattr(attr) for attr in in_var.ncattrs() if attr != "_FillValue"})
+            out_var.setncatts(attributes.get(name, {}))
+            if data is None:
+                out_var.assignValue(in_var.getValue())
+            else:
+                out_var[:] = data
+
+
+def term_shell(shell_args: str, err_message: str, clean: bool, step: str = None):
     """
     This function gets arguments "shell_args" what should be executed as a shell command.
     If this does not work "err_message" is printed and the program will exit.
+    The command is run by the executor (no shell, see executor.run_command()), which records it for the job report.
     @param shell_args: arguments that should be executed in shell
     @param err_message: message that should be printed if the execution fails
     @param clean: specifies weather a cleanup should be executed
+    @param step: step of the pipeline the command belongs to (default: name of the tool)
     """
-    return_code = subprocess.call(shell_args, shell=True)
-    if return_code != 0:
-        print("term_shell is failed in progress for command: {shell_args}".format(shell_args = shell_args))
+    record = run_command(shell_args, step)
+    if record["exit_code"] != 0:
+        print("term_shell is failed in progress for command: {shell_args}".format(shell_args = record["command"]))
+        print(record["stderr"])
         #if clean:
         #    cleanup() #TODO: If cleaning needs to be done by everyone this needs to be adapted
         #print(" Term Shell is failed")
@@ -290,52 +374,206 @@ def term_shell(shell_args: str, err_message: str, clean: bool):
         raise SlaveError(function="term_shell()", message=err_message)
 
 
-def split_time_steps(s_file, COMPRESS_LEVEL, relative_split_dir):
+@netcdf_locked
+def split_and_rename_time_steps(o_file_path, s_file):
+    """
+    Splits the converted file s_file into its time steps in a single pass (formerly cdo splitsel + one ncap2 per time
+    step): s_file is opened once and every time step is written directly to o_file_path as
+    time:<model_start>.<FF>.<mEE>.nc.
+    As before, the time variable gets the forecast hour as value and its units are changed to
+    'hours since model run start'. All other variables and attributes are copied as they are.
+    The local workers of a rank split their files one after the other (see nclock.py), grib_to_netcdf() of other files
+    runs in the meantime.
+    @param o_file_path: the path where the data should be stored at
+    @param s_file: the file name before it got split into the time steps
     """
-    automatically splits the data in the 8 time steps defined in the file (nc_file). The outgoing files where stored
-    in split_dir named output00000X
-    Each of this eight outgoing files contain only one time step
-    @param s_file: file name of the file that should be splitted in the different time_steps.
+    forecast_hour, ensemble = time_step_name_parts(s_file)
+    with Dataset(s_file, "r") as in_file:
+        time_var = in_file.variables["time"]
+        calendar = getattr(time_var, "calendar", "standard")
+        for index in range(len(time_var)):
+            # the value of the 'time'-variable of the time step. This value is stored in "time_step"
+            time_step = num2date(time_var[index], time_var.units, calendar)
+            time_step = datetime(time_step.year, time_step.month, time_step.day, time_step.hour, time_step.minute,
+                                 time_step.second)
+            model_start = time_step - timedelta(hours=int(forecast_hour))  # time the model run starts
+            hours_since = model_start.strftime("%Y-%m-%d %H:%M:%S")
+            out_file = "{0}/time:{1}.{2}.{3}.nc".format(o_file_path, model_start.strftime("%Y%m%d-%H"), forecast_hour,
+                                                        ensemble)
+            write_time_step(in_file, index, out_file, float(forecast_hour), "hours since {0} ".format(hours_since))
+    print("{0:20} ...ok".format("Split + time change"))
+
+
+@netcdf_locked
+def write_time_step(in_file, index, out_file, time_value, time_units):
     """
-    try:
-        args = "cdo{0}-s splitsel,1 {1} {2}/output > /dev/null 2>&1".format(COMPRESS_LEVEL, s_file, relative_split_dir)
-        term_shell(args, "Failed splitting '{0}'".format(s_file), False)
-        print("{0:20} ...ok".format("Split time steps"))
-    except SlaveError:
-        raise
+    Copies the time step index of the open netCDF-file in_file to out_file. The time variable gets time_value as value
+    and time_units as units, everything else is copied unchanged.
+    @param in_file: open netCDF4.Dataset
+    @param index: index of the time step
+    @param out_file: name of the netCDF-file to be created
+    @param time_value: new value of the time variable
+    @param time_units: new units of the time variable
+    """
+    time_dependent = {}
+    for name, in_var in in_file.variables.items():
+        if name == "time":
+            time_dependent[name] = np.array([time_value])
+        elif "time" in in_var.dimensions:
+            selection = [slice(None)] * len(in_var.dimensions)
+            selection[in_var.dimensions.index("time")] = slice(index, index + 1)
+            time_dependent[name] = in_var[tuple(selection)]
+    write_like(in_file, out_file, time_dependent, {"time": {"units": time_units}})
+
+
+@netcdf_locked
+def write_like(template, out_file, time_dependent, attributes=None, renames=None):
+    """
+    Creates out_file with the format, dimensions, variables and attributes of the open netCDF-file template.
+    The time-dependent variables get the arrays given in time_dependent (the length of the time dimension follows from
+    them), all other variables are copied from template.
+    @param template: open netCDF4.Dataset
+    @param out_file: name of the netCDF-file to be created
+    @param time_dependent: dictionary variable name -> array of all time steps (time must be the dimension of it)
+    @param attributes: dictionary variable name -> dictionary of attributes that are set on top of the copied ones
+    @param renames: dictionary variable name -> name of the variable in out_file (like cdo chname)
+    (time_dependent and attributes use the variable names of template)
+    """
+    attributes = attributes or {}
+    renames = renames or {}
+    with Dataset(out_file, "w", format=template.data_model) as out:
+        out.setncatts({name: template.getncattr(name) for name in template.ncattrs()})
+        for name, dimension in template.dimensions.items():
+            out.createDimension(name, None if dimension.isunlimited() else len(dimension))
+        for name, in_var in template.variables.items():
+            fill_value = in_var.getncattr("_FillValue") if "_FillValue" in in_var.ncattrs() else None
+            out_var = out.createVariable(renames.get(name, name), in_var.datatype, in_var.dimensions, fill_value=fill_value)
+            out_var.setncatts({attr: in_var.getncattr(attr) for attr in in_var.ncattrs() if attr != "_FillValue"})
+            out_var.setncatts(attributes.get(name, {}))
+            if name in time_dependent:
+                out_var[:] = time_dependent[name]
+            elif len(in_var.dimensions) > 0:
+                out_var[:] = in_var[:]
+            else:
+                out_var.assignValue(in_var.getValue())
+
+
+def time_step_name_parts(s_file):
+    """
+    Extracts the forecast hour and the ensemble member from the name of the file that gets split into the time steps.
+    @param s_file: file name of the converted file (preproc-cdeYYYYMMDD.FF.mEE.nc, see define_nc_file())
+    @return: forecast hour (FF) and ensemble member (mEE) as they are written in the file name
+    """
+    store = os.path.basename(s_file)  # use name of datafile that got splitted ("parent file")
+    store = store.split("-")[1]  # cdeYYYYMMDD.FF.mEE.nc
+    store = store.split(".")  # [cdeYYYYMMDD][FF][mEE][nc]
+    forecast_hour = store[-3]  # FF
+    ensemble = store[-2]  # mEE
+    return forecast_hour, ensemble
 
 
-def rename_splitted_data(o_file_path, s_file, relative_split_dir):
+def read_grid_description(grid_des):
+    """
+    Reads a CDO grid description file (key = value per line, comments start with #).
+    @param grid_des: path of the grid description file
+    @return: dictionary with the (unquoted) values as strings
+    """
+    grid = {}
+    with open(grid_des) as grid_file:
+        for line in grid_file:
+            line = line.split("#")[0].strip()
+            if "=" in line:
+                key, value = line.split("=", 1)
+                grid[key.strip()] = value.strip().strip('"').strip()
+    return grid
+
+
+@netcdf_locked
+def write_decoded_time_steps(fields, o_file_path, in_file, grid_des, compress_lvl: int = 6):
     """
-    The previous step created 8 files named 'output00000X'. This function renames this files to meaningful names.
-    The new file name contains the model run start time and the 'forecast hour' and 'ensemble' of the old data file
-    (the parent file s_file)
-    Also the content of the new file needs to be changed. The time variable gets the forecast hour as time value, the
-    units of this variable will be changed to 'hours since model run start'.
+    Writes the messages decoded in-process (see decoder.decode_grib()) as time:<model_start>.<FF>.<mEE>.nc files,
+    i.e. the same files split_and_rename_time_steps() creates from the output of grib_to_netcdf().
+    The time variable gets the forecast hour as value and 'hours since model run start' as units.
+    @param fields: decoded messages of one variable
     @param o_file_path: the path where the data should be stored at
-    @param s_file: the file name before it got split into the time steps
+    @param in_file: the GRIB file the messages are decoded from (its name defines FF and mEE)
+    @param grid_des: CDO grid description of the native COSMO grid
+    @param compress_lvl: level for zip-compression (0: no compression)
     """
-    try:
-        for datafile in glob.glob(relative_split_dir + "/out*"):
-            # check the value of the 'time'-variable in the given file. This values is stored in "time_step"
-            time_step = datetime.strptime(subprocess.check_output(["cdo", "-s", "-showtimestamp", datafile])
-                                          .decode(sys.stdout.encoding).strip(), "%Y-%m-%dT%H:%M:%S")
-            store = os.path.basename(s_file)  # use name of datafile that got splitted ("parent file")
-            store = store.split("-")[1]  # cdeYYYYMMDD.FF.mEE.nc
-            store = store.split(".")  # [cdeYYYYMMDD][FF][mEE][nc]
-            forecast_hour = store[-3]  # FF
-            ensemble = store[-2]  # mEE
-            model_start = time_step - timedelta(hours=int(forecast_hour))  # time the model run starts (stored in ansi)
-            hours_since = model_start.strftime("%Y-%m-%d %H:%M:%S")  # just convert it to a string
-            model_start = model_start.strftime("%Y%m%d-%H")  # the same, just an other format
-
-            args = "ncap2 -s 'time += {0} - time' -s 'time@units=\"hours since {1} \"' {2} {3}/time:{4}.{5}.{6}.nc" \
-                .format(forecast_hour, hours_since, datafile, o_file_path, model_start, forecast_hour, ensemble)
-            term_shell(args, "Time change failed", False)
-            os.remove(datafile)  # the old file with the "wrong" content named "output00000X" can be removed
-        print("{0:20} ...ok".format("Time change + mv"))
-    except SlaveError:
-        raise
+    var_name = os.path.basename(o_file_path)
+    forecast_hour, ensemble = time_step_name_parts(define_nc_file("", in_file))
+    grid = read_grid_description(grid_des)
+
+    for field in fields:
+        out_file = "{0}/time:{1}.{2}.{3}.nc".format(o_file_path, field["model_start"].strftime("%Y%m%d-%H"),
+                                                    forecast_hour, ensemble)
+        nc_file = create_decoded_file(out_file, var_name, field, float(forecast_hour), grid, in_file, compress_lvl)
+        nc_file.close()
+    print("{0:20} ...ok".format("Decoded time steps"))
+
+
+@netcdf_locked
+def create_decoded_file(out_file, var_name, field, time_value, grid, in_file, compress_lvl: int = 6,
+                        diskless=False):
+    """
+    Creates a netCDF-file on the native COSMO grid holding one decoded message (see decoder.decode_grib()) as time step.
+    @param out_file: name of the netCDF-file to be created
+    @param var_name: name of the variable
+    @param field: decoded message
+    @param time_value: value of the time variable (forecast hour, units are 'hours since model run start')
+    @param grid: CDO grid description of the native COSMO grid (see read_grid_description())
+    @param in_file: the GRIB file the message is decoded from (noted in the history)
+    @param compress_lvl: level for zip-compression (0: no compression)
+    @param diskless: keep the file in memory only (e.g. as template for write_like())
+    @return: the open netCDF4.Dataset (to be closed by the caller holding nclock.NETCDF_LOCK)
+    """
+    method = create_decoded_file.__name__
+
+    xsize, ysize = int(grid["xsize"]), int(grid["ysize"])
+    rlon = float(grid["xfirst"]) + float(grid["xinc"]) * np.arange(xsize)
+    rlat = float(grid["yfirst"]) + float(grid["yinc"]) * np.arange(ysize)
+    compress_lvl = int(compress_lvl)
+    if field["values"].shape != (ysize, xsize):
+        raise SlaveError(function="{0}()".format(method),
+                         message="Field of {0} in {1} does not fit to the grid {2}".format(var_name, in_file,
+                                                                                         grid["gridsize"]))
+
+    nc_file = Dataset(out_file, "w", format="NETCDF4", diskless=diskless, persist=False)
+    nc_file.Conventions = "CF-1.6"
+    nc_file.history = "{0}: decoded from {1} with ecCodes".format(datetime.now().strftime("%c"), in_file)
+    nc_file.createDimension("time", None)
+    nc_file.createDimension("rlon", xsize)
+    nc_file.createDimension("rlat", ysize)
+
+    time_var = nc_file.createVariable("time", "f8", ("time",))
+    time_var.standard_name = "time"
+    time_var.units = "hours since {0} ".format(field["model_start"].strftime("%Y-%m-%d %H:%M:%S"))
+    time_var.calendar = "proleptic_gregorian"
+    time_var.axis = "T"
+    time_var[:] = [time_value]
+
+    for name, coordinate_values, axis in (("rlon", rlon, "X"), ("rlat", rlat, "Y")):
+        coordinate = nc_file.createVariable(name, "f8", (name,))
+        coordinate.standard_name = "grid_longitude" if axis == "X" else "grid_latitude"
+        coordinate.long_name = grid["{0}longname".format(axis.lower())]
+        coordinate.units = grid["{0}units".format(axis.lower())]
+        coordinate.axis = axis
+        coordinate[:] = coordinate_values
+
+    rotated_pole = nc_file.createVariable(grid["grid_mapping"], "i4")
+    rotated_pole.grid_mapping_name = grid["grid_mapping_name"]
+    rotated_pole.grid_north_pole_latitude = float(grid["grid_north_pole_latitude"])
+    rotated_pole.grid_north_pole_longitude = float(grid["grid_north_pole_longitude"])
+
+    data_var = nc_file.createVariable(var_name, "f4", ("time", "rlat", "rlon"), zlib=compress_lvl > 0,
+                                      complevel=max(compress_lvl, 1), fill_value=np.float32(-9.e+33))
+    data_var.long_name = field["long_name"]
+    data_var.units = field["units"]
+    data_var.param = field["param"]
+    data_var.grid_mapping = grid["grid_mapping"]
+    data_var.missing_value = np.float32(-9.e+33)
+    data_var[0, :, :] = field["values"]
+    return nc_file
 
 
 def cleanup(relative_split_dir, relative_filter_file):
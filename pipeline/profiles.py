@@ -0,0 +1,144 @@
+"""
+Storage profiles of the processed files.
+
+A profile sets the chunk shape along (time, lat, lon), the shuffle filter and the codec with its level of the fields in
+the final remapped and native files, so the files can be laid out like the tiles rasdaman reads with wcst_import
+("insitu": true), e.g. "aligned [0:0,0:0,0:0,0:5,0:420,0:460]" reads 6 time steps of the whole grid at once.
+A profile is given as one string of ":"-separated tokens in any order (OUTPUT_PROFILES in the parameter file, one per
+variable), e.g. "6x461x421:shuffle:zlib:4":
+    <time>x<lat>x<lon> -- chunk shape (0: whole dimension), "auto" leaves the chunking to the netCDF library
+    shuffle / noshuffle -- byte shuffle filter before the codec
+    zlib / none -- codec (netCDF4-python 1.5.4 only offers zlib)
+    <level> -- level of the codec (1 to 9)
+Tokens that are not given are taken from the default profile (see default_profile()).
+"""
+from collections import namedtuple
+
+CODECS = ("none", "zlib")
+
+OutputProfile = namedtuple("OutputProfile", ["chunks", "shuffle", "codec", "level"])
+
+# dimensions that are chunked along the time, latitude and longitude entry of the chunk shape
+TIME_DIMS = ("time",)
+LAT_DIMS = ("lat", "rlat")
+LON_DIMS = ("lon", "rlon")
+
+
+# ======================= List of functions ====================================== #
+
+
+def default_profile(compress_lvl=0):
+    """
+    Returns the profile of the processed files without an explicit profile: chunking by the netCDF library and zlib
+    without shuffle at compress_lvl (COMPRESS_LEVEL in the parameter file), which is what cdo -z zip_<compress_lvl>
+    writes.
+    @param compress_lvl: level for zip-compression (0: no compression)
+    @return: OutputProfile
+    """
+    compress_lvl = int(compress_lvl)
+    return OutputProfile(None, False, "zlib" if compress_lvl > 0 else "none", max(compress_lvl, 0))
+
+
+def parse_profile(spec, compress_lvl=0):
+    """
+    Parses a profile string (see module description).
+    @param spec: profile string, "" gives the default profile
+    @param compress_lvl: level for zip-compression of the default profile
+    @return: OutputProfile
+    """
+    method = parse_profile.__name__
+    profile = default_profile(compress_lvl)
+    for token in filter(None, (token.strip().lower() for token in spec.split(":"))):
+        if token == "auto":
+            profile = profile._replace(chunks=None)
+        elif "x" in token:
+            try:
+                chunks = tuple(int(size) for size in token.split("x"))
+            except ValueError:
+                chunks = ()
+            if len(chunks) != 3 or min(chunks) < 0:
+                raise ValueError("%{0}: Invalid chunk shape '{1}' chosen. Give <time>x<lat>x<lon>, e.g. 6x461x421."
+                                 .format(method, token))
+            profile = profile._replace(chunks=chunks)
+        elif token in ("shuffle", "noshuffle"):
+            profile = profile._replace(shuffle=token == "shuffle")
+        elif token in CODECS:
+            profile = profile._replace(codec=token)
+        elif token.isdigit():
+            profile = profile._replace(level=int(token))
+        else:
+            raise ValueError("%{0}: Unknown token '{1}' in output profile '{2}'. Choose a chunk shape, shuffle, "
+                             "noshuffle, one of the codecs {3} or a level.".format(method, token, spec, ", ".join(CODECS)))
+    if profile.codec == "none":  # e.g. "none" with COMPRESS_LEVEL = 6
+        profile = profile._replace(shuffle=False, level=0)
+    elif profile.codec == "zlib":
+        if profile.level == 0:  # e.g. "zlib" with COMPRESS_LEVEL = 0
+            profile = profile._replace(level=default_profile(6).level)
+        if not 1 <= profile.level <= 9:
+            raise ValueError("%{0}: Invalid compression level '{1}' chosen. Value must be within 1 and 9."
+                             .format(method, profile.level))
+    return profile
+
+
+def needs_netcdf4(profile):
+    """
+    @param profile: OutputProfile
+    @return: True if the profile can't be written as netCDF classic (compression or chunking)
+    """
+    return profile.codec != "none" or profile.chunks is not None
+
+
+def chunk_sizes(profile, dimensions, shape):
+    """
+    Returns the chunk shape of a variable. The time, latitude and longitude dimensions get the entry of the chunk shape
+    of the profile (limited to the size of the dimension), all other dimensions are not split.
+    @param profile: OutputProfile
+    @param dimensions: names of the dimensions of the variable
+    @param shape: sizes of the dimensions (unlimited dimensions: number of time steps that are written)
+    @return: list of chunk sizes, None if the netCDF library chooses
+    """
+    if profile.chunks is None or len(dimensions) == 0:
+        return None
+    sizes = []
+    for dim, size in zip(dimensions, shape):
+        chunk = 0
+        for index, names in enumerate((TIME_DIMS, LAT_DIMS, LON_DIMS)):
+            if dim in names:
+                chunk = profile.chunks[index]
+        sizes.append(max(min(chunk or size, size), 1))
+    return sizes
+
+
+def variable_options(profile, dimensions, shape):
+    """
+    Returns the keyword arguments for netCDF4.Dataset.createVariable() of a field.
+    @param profile: OutputProfile
+    @param dimensions: names of the dimensions of the variable
+    @param shape: sizes of the dimensions
+    @return: dictionary with zlib, complevel, shuffle and chunksizes
+    """
+    options = {"zlib": profile.codec == "zlib" and len(dimensions) > 0, "complevel": max(profile.level, 1),
+               "shuffle": profile.shuffle and profile.codec != "none"}
+    chunks = chunk_sizes(profile, dimensions, shape)
+    if chunks is not None:
+        options["chunksizes"] = chunks
+    return options
+
+
+def nccopy_options(profile, dimensions=("time", "lat", "lon")):
+    """
+    Returns the options of nccopy that rewrite a file with the profile (used for the files written by cdo).
+    @param profile: OutputProfile
+    @param dimensions: names of the time, latitude and longitude dimension of the file
+    @return: option string
+    """
+    options = ["-k nc4c"]
+    if profile.codec == "zlib":
+        options.append("-d {0:d}".format(profile.level))
+    if profile.shuffle and profile.codec != "none":
+        options.append("-s")
+    if profile.chunks is not None:
+        chunks = ["{0}/{1}".format(dim, size) for dim, size in zip(dimensions, profile.chunks) if size > 0]
+        if chunks:
+            options.append("-c {0}".format(",".join(chunks)))
+    return " ".join(options)
@@ -0,0 +1,194 @@
+"""
+Remapping with precomputed weights.
+
+The interpolation weights from the native COSMO grid to the target grid are generated once with CDO (gencon, gencon2,
+..) and stored in a weights directory. The name of the weights file contains a hash of both grid description files and
+the method, so a changed grid description leads to new weights. The weights are applied as a sparse matrix to all
+time steps of a model run at once, which replaces one "cdo remapcon" (that computes the weights again) per output file.
+SciPy is optional: without it the pipeline remaps with "cdo remapcon" (Remap_Engine = cdo in the parameter file).
+"""
+import os
+import hashlib
+import numpy as np
+from netCDF4 import Dataset
+
+from prepros import term_shell
+from prepros import read_grid_description
+from profiles import default_profile
+from profiles import needs_netcdf4
+from profiles import variable_options
+from nclock import NETCDF_LOCK
+from nclock import netcdf_locked
+
+try:
+    import scipy.sparse
+except ImportError:  # cdo remapcon is used instead
+    scipy = None
+
+MISSING_VALUE = -999.9  # treated as missing value before remapping (like cdo -setctomiss,-999.9, needed for CIN_ML)
+
+# weights files that were already read by this rank: path -> sparse matrix (target cells x source cells)
+WEIGHTS_CACHE = {}
+
+
+# ======================= List of functions ====================================== #
+
+
+def sparse_available():
+    """
+    @return: True if SciPy can be used to apply the remapping weights
+    """
+    return scipy is not None
+
+
+def weights_file(weights_dir, ingrid, outgrid, remap_method="conservative"):
+    """
+    Returns the path of the weights file for the given grid pair and method.
+    @param weights_dir: directory where the weights are stored
+    @param ingrid: CDO grid description of the input data
+    @param outgrid: CDO grid description of the target grid
+    @param remap_method: method for remapping (see prepros.remapfunc_cdo())
+    @return: path of the weights file (<weights_dir>/<method>_<hash>.nc)
+    """
+    key = hashlib.sha1(remap_method.encode())
+    for grid_des in (ingrid, outgrid):
+        with open(grid_des, "rb") as grid_file:
+            key.update(grid_file.read())
+    return "{0}/{1}_{2}.nc".format(weights_dir, remap_method, key.hexdigest()[:16])
+
+
+def generate_weights(ingrid, outgrid, out_file, remap_method="conservative"):
+    """
+    Generates the remapping weights with CDO unless out_file already exists. The weights are written to a temporary
+    file first and renamed when complete, so a killed job never leaves half-written weights behind.
+    @param ingrid: CDO grid description of the input data
+    @param outgrid: CDO grid description of the target grid
+    @param out_file: path of the weights file (see weights_file())
+    @param remap_method: method for remapping (see prepros.remapfunc_cdo())
+    @return: True if the weights were generated, False if they existed already
+    """
+    if os.path.isfile(out_file):
+        return False
+    known_gen = {"bilinear": "genbil", "bicubic": "genbic", "nearest_neighbor": "gennn",
+                 "distance_weighted": "gendis", "conservative": "gencon", "conservative2": "gencon2",
+                 "largest_area_fraction": "genlaf"}
+    if remap_method not in known_gen:
+        raise ValueError("%{0}: Chosen method for remapping '{1}' is unknown. Choose one of the following: {2}"
+                         .format(generate_weights.__name__, remap_method, ", ".join(known_gen.keys())))
+
+    os.makedirs(os.path.dirname(out_file), exist_ok=True)
+    temp_file = "{0}/.partial-{1}".format(os.path.dirname(out_file), os.path.basename(out_file))
+    # a constant field on the input grid is enough, the weights only depend on the grids
+    shell_args = "cdo -O -s {0},{1} -const,1,{2} {3}".format(known_gen[remap_method], outgrid, ingrid, temp_file)
+    term_shell(shell_args, "Failed generating the weights for remapping '{0}' to '{1}'".format(ingrid, outgrid), False,
+               "weights")
+    os.replace(temp_file, out_file)
+    return True
+
+
+@netcdf_locked
+def read_weights(in_file):
+    """
+    Reads the weights file (SCRIP format as written by CDO) into a sparse matrix. The matrix is read only once per rank.
+    @param in_file: path of the weights file
+    @return: sparse matrix with one row per target cell and one column per source cell
+    """
+    if in_file not in WEIGHTS_CACHE:
+        with Dataset(in_file, "r") as nc_file:
+            src_address = nc_file.variables["src_address"][:] - 1  # SCRIP addresses start with 1
+            dst_address = nc_file.variables["dst_address"][:] - 1
+            weights = nc_file.variables["remap_matrix"][:, 0]
+            shape = (len(nc_file.dimensions["dst_grid_size"]), len(nc_file.dimensions["src_grid_size"]))
+        WEIGHTS_CACHE[in_file] = scipy.sparse.csr_matrix((weights, (dst_address, src_address)), shape=shape)
+    return WEIGHTS_CACHE[in_file]
+
+
+def remap_fields(matrix, data, out_shape):
+    """
+    Applies the weights to all fields in one sparse matrix product. Missing values of the input (masked or -999.9) are
+    left out and the weights of the remaining source cells are renormalized, target cells without any valid source cell
+    are masked (like CDO).
+    @param matrix: sparse matrix (see read_weights())
+    @param data: masked array (time, rlat, rlon) on the input grid
+    @param out_shape: (lat, lon) shape of the target grid
+    @return: masked array (time, lat, lon) on the target grid
+    """
+    data = np.ma.masked_values(np.ma.asarray(data, dtype=np.float64), MISSING_VALUE)
+    fields = data.reshape(data.shape[0], -1).T  # one column per time step
+    valid = (~np.ma.getmaskarray(fields)).astype(np.float64)
+    values = matrix.dot(fields.filled(0.))
+    norm = matrix.dot(valid)
+    remapped = np.ma.masked_where(norm <= 0., values / np.where(norm > 0., norm, 1.))
+    return remapped.T.reshape((data.shape[0],) + tuple(out_shape))
+
+
+def write_remapped(template, out_file, time_dependent, matrix, outgrid, attributes=None, renames=None, profile=None):
+    """
+    Remaps the time steps of the open netCDF-file template and writes them on the target grid (lon, lat) like
+    "cdo remapcon" would (see prepros.remap_data()).
+    @param template: open netCDF4.Dataset on the native grid (gives dimensions, variables and attributes)
+    @param out_file: name of the netCDF-file to be created
+    @param time_dependent: dictionary variable name -> array of all time steps (see merger.read_time_steps())
+    @param matrix: sparse matrix (see read_weights())
+    @param outgrid: CDO grid description of the target grid
+    @param attributes: dictionary variable name -> dictionary of attributes that are set on top of the copied ones
+    @param renames: dictionary variable name -> name of the variable in out_file
+    @param profile: chunking and compression of the field (see profiles.parse_profile(), default: netCDF classic like
+    cdo -f nc)
+    """
+    profile = profile or default_profile()
+    attributes = attributes or {}
+    renames = renames or {}
+    grid = read_grid_description(outgrid)
+    lon = float(grid["xfirst"]) + float(grid["xinc"]) * np.arange(int(grid["xsize"]))
+    lat = float(grid["yfirst"]) + float(grid["yinc"]) * np.arange(int(grid["ysize"]))
+
+    spatial = ("rlat", "rlon")
+    with NETCDF_LOCK:
+        fields = [name for name, in_var in template.variables.items() if set(spatial) <= set(in_var.dimensions)]
+    # the sparse products run outside the lock, so the local workers of the rank remap at the same time (see nclock.py)
+    remapped = {name: remap_fields(matrix, time_dependent[name], (len(lat), len(lon))) for name in fields}
+
+    # netCDF classic does not support zip and chunking
+    out_format = "NETCDF4_CLASSIC" if needs_netcdf4(profile) else "NETCDF3_CLASSIC"
+    with NETCDF_LOCK, Dataset(out_file, "w", format=out_format) as out:
+        grid_mappings = set(getattr(var, "grid_mapping", None) for var in template.variables.values())
+        out.setncatts({name: template.getncattr(name) for name in template.ncattrs()})
+        for name, dimension in template.dimensions.items():
+            if name not in spatial:
+                out.createDimension(name, None if dimension.isunlimited() else len(dimension))
+        out.createDimension("lon", len(lon))
+        out.createDimension("lat", len(lat))
+        out_lon = out.createVariable("lon", "f8", ("lon",))
+        out_lon.setncatts({"standard_name": "longitude", "long_name": "longitude", "units": "degrees_east",
+                           "axis": "X"})
+        out_lon[:] = lon
+        out_lat = out.createVariable("lat", "f8", ("lat",))
+        out_lat.setncatts({"standard_name": "latitude", "long_name": "latitude", "units": "degrees_north",
+                           "axis": "Y"})
+        out_lat[:] = lat
+
+        for name, in_var in template.variables.items():
+            if name in grid_mappings or (in_var.dimensions and set(in_var.dimensions) <= set(spatial)):
+                continue  # rotated_pole, rlon, rlat are replaced by lon and lat
+            fill_value = in_var.getncattr("_FillValue") if "_FillValue" in in_var.ncattrs() else None
+            dimensions = tuple({"rlat": "lat", "rlon": "lon"}.get(dim, dim) for dim in in_var.dimensions)
+            is_field = name in remapped
+            options = {}
+            if is_field:
+                fill_value = np.float32(-9e33) if fill_value is None else fill_value
+                options = variable_options(profile, dimensions, remapped[name].shape)
+            out_var = out.createVariable(renames.get(name, name), in_var.datatype, dimensions, fill_value=fill_value,
+                                         **options)
+            out_var.setncatts({attr: in_var.getncattr(attr) for attr in in_var.ncattrs()
+                               if attr not in ("_FillValue", "grid_mapping", "coordinates")})
+            out_var.setncatts(attributes.get(name, {}))
+            if is_field:
+                out_var.missing_value = out_var._FillValue
+                out_var[:] = remapped[name]
+            elif name in time_dependent:
+                out_var[:] = time_dependent[name]
+            elif len(in_var.dimensions) > 0:
+                out_var[:] = in_var[:]
+            else:
+                out_var.assignValue(in_var.getValue())
@@ -0,0 +1,175 @@
+from mpi4py import MPI
+import sys
+import time
+import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+# ini. MPI
+comm = MPI.COMM_WORLD
+my_rank = comm.Get_rank()  # rank of the node
+p = comm.Get_size()  # number of assigned nods
+
+if my_rank == 0:  # node is master
+
+    logger = logging.getLogger(__file__)
+    logger.addHandler(logging.StreamHandler(sys.stdout))
+
+# ======================= MPI message tags ======================================= #
+TAG_REQUEST = 11  # slave -> master : ask for the next item (carries the reports of the finished ones)
+TAG_WORK = 12  # master -> slave : next item to process, None if the queue is drained, STOP at the deadline
+
+STOP = "stop"  # sent instead of an item once the deadline is reached : the items received ahead are given back
+
+POLL_INTERVAL = 0.05  # seconds the master sleeps when no message is pending
+MAX_MESSAGE_SIZE = 1 << 20  # receive buffer for the non-blocking receives of the master
+
+
+# ======================= List of functions ====================================== #
+
+
+def master_scheduler(work_queue, num_workers, process_item=None, local_workers=1, on_done=None, stop_time=None):
+    """
+    Hands out the items of work_queue to the slaves on request. The slaves ask for the next item once a local worker
+    is free, so the queue is drained in its order (largest first, see helper.work_queue_builder()).
+    Incoming messages are tracked with non-blocking receives. Every slave gets None once the queue is empty (STOP
+    once the deadline is reached) and sends a last message when all of its items are finished.
+    If process_item is given, the master processes items as well: up to local_workers items run in a pool of threads
+    while the master keeps polling for the messages of the slaves in between (see worker_loop() for when this is safe).
+    @param work_queue: ordered list of the items to process
+    @param num_workers: number of slaves that will ask for work
+    @param process_item: function that processes one item on the master (None: the master only distributes)
+    @param local_workers: number of items processed at the same time on the master
+    @param on_done: function called with every finished item (e.g. to record it in the manifest)
+    @param stop_time: seconds since the epoch after which no new item is handed out (None: no limit). The items that
+                      are already running are finished, the rest is returned.
+    @return: list of the reports sent back by the slaves (and the master), list of the items that were not processed
+             (not handed out or given back by the slaves at the deadline)
+    """
+    pending = deque(work_queue)
+    reports = []
+    active_workers = num_workers
+    running = {}  # future -> item
+    executor = None
+    if process_item is not None:
+        executor = ThreadPoolExecutor(max_workers=local_workers)
+
+    request = None
+    if active_workers > 0:
+        request = comm.irecv(bytearray(MAX_MESSAGE_SIZE), source=MPI.ANY_SOURCE, tag=TAG_REQUEST)
+
+    stopping = False
+    while active_workers > 0 or running or (executor is not None and pending and not stopping):
+        busy = False
+        if not stopping and stop_time is not None and time.time() >= stop_time:  # also stops the items received ahead
+            stopping = True
+            logger.critical("Deadline is reached -> {left} items are not handed out".format(left=len(pending)))
+
+        # Receive : serve the slaves first, they are blocked until they get an answer
+        if request is not None:
+            done, message = request.test()
+            if done:
+                busy = True
+                worker_rank, worker_reports, finished, returned = message
+                for item, report in worker_reports:
+                    logger.info(report)
+                    reports.append(report)
+                    if on_done is not None:
+                        on_done(item)
+
+                if finished:  # the slave has no item left and will not ask again
+                    active_workers = active_workers - 1
+                    pending.extend(returned)  # received ahead, but not started before the deadline
+                elif pending and not stopping:
+                    item = pending.popleft()
+                    logger.info("Item {item} is sent to processor {rank} ({left} left)"
+                                .format(item=item, rank=worker_rank, left=len(pending)))
+                    comm.send(item, dest=worker_rank, tag=TAG_WORK)
+                else:
+                    comm.send(STOP if stopping else None, dest=worker_rank, tag=TAG_WORK)
+
+                request = None
+                if active_workers > 0:
+                    request = comm.irecv(bytearray(MAX_MESSAGE_SIZE), source=MPI.ANY_SOURCE, tag=TAG_REQUEST)
+
+        # Process : keep the local workers of the master busy
+        if executor is not None:
+            while pending and not stopping and len(running) < local_workers:
+                item = pending.popleft()
+                logger.info("Item {item} is processed by the master ({left} left)".format(item=item,
+                                                                                          left=len(pending)))
+                running[executor.submit(process_item, item)] = item
+            finished = [future for future in running if future.done()]
+            for future in finished:
+                busy = True
+                item = running.pop(future)
+                report = future.result()  # errors of an item are raised here like on the slaves
+                logger.info(report)
+                reports.append(report)
+                if on_done is not None:
+                    on_done(item)
+
+        if not busy:
+            time.sleep(POLL_INTERVAL)
+
+    if executor is not None:
+        executor.shutdown()
+    return reports, list(pending)
+
+
+def worker_loop(process_item, local_workers=1, prefetch=None):
+    """
+    Asks the master for items until the queue is drained and runs process_item on each of them. Up to local_workers
+    items are processed at the same time by a pool of threads. Much of the work of every item is done by external
+    tools (grib_filter, cdo, nccopy), so the threads keep that many of them running on the cores of the rank.
+    local_workers > 1 is only safe for process_item functions that hold nclock.NETCDF_LOCK around every in-process use
+    of netCDF4 (netCDF-C and HDF5 are not thread-safe), like the tasks of main.py do. The threads then only overlap in
+    the external tools, the decoding and the NumPy work.
+    If prefetch is given, one more item is asked for ahead of time and prefetch is called with it, so its input can be
+    staged while the current items are processed (see stager.InputStager). If the master sends STOP (deadline), the
+    items received ahead are not started but given back, so they do not run into the end of the job.
+    @param process_item: function that processes one item and returns a report (str) for the master
+    @param local_workers: number of items processed at the same time on this rank
+    @param prefetch: function called with every item that is received ahead (None: no item is received ahead)
+    @return: number of processed items
+    """
+    reports = []  # (item, report) of the finished items
+    processed = 0
+    drained = False
+    running = {}  # future -> item
+    queued = deque()  # items received ahead, they are started once a local worker is free
+    returned = []  # items received ahead that are given back to the master (deadline)
+    lookahead = 0 if prefetch is None else 1
+    with ThreadPoolExecutor(max_workers=local_workers) as executor:
+        while True:
+            if not drained and len(running) + len(queued) < local_workers + lookahead:
+                # a local worker (or the lookahead) is free : ask for the next item and hand over the reports
+                # collected so far. This is done before a queued item is started, so it is given back on STOP
+                comm.send((my_rank, reports, False, []), dest=0, tag=TAG_REQUEST)
+                reports = []
+                item = comm.recv(source=0, tag=TAG_WORK)
+                if item is None:
+                    drained = True
+                elif item == STOP:
+                    drained = True
+                    returned = list(queued)
+                    queued.clear()
+                elif len(running) + len(queued) < local_workers:
+                    running[executor.submit(process_item, item)] = item
+                else:
+                    queued.append(item)
+                    prefetch(item)
+                continue
+            while queued and len(running) < local_workers:
+                item = queued.popleft()
+                running[executor.submit(process_item, item)] = item
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                item = running.pop(future)
+                reports.append((item, future.result()))  # errors of an item are raised here like in a serial run
+                processed = processed + 1
+
+    comm.send((my_rank, reports, True, returned), dest=0, tag=TAG_REQUEST)
+    return processed
@@ -0,0 +1,109 @@
+"""
+Prefetching of the input files of the next task.
+
+While a rank processes its current tasks, the input files of the task it received ahead (see scheduler.worker_loop())
+are copied to a node-local directory in the background, or - without such a directory - read ahead into the page
+cache. Only the first task of a rank reads its input files cold. The staged copies are limited by a byte budget and
+removed as soon as the task is done, the directory when the rank is finished.
+"""
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class InputStager:
+    """Stages the input files of upcoming tasks in the background.
+
+    Attributes:
+        stage_dir -- node-local directory for the copies (None: the files are only read ahead)
+        budget -- maximum number of bytes staged at the same time
+    """
+
+    def __init__(self, stage_dir, budget):
+        self.stage_dir = stage_dir
+        self.budget = budget
+        self.staged_bytes = 0
+        self.staged = {}  # input file -> (future of the path to read from, size)
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=1)  # one stream of reads next to the processing
+        if stage_dir is not None:
+            os.makedirs(stage_dir, exist_ok=True)
+
+    def prefetch(self, input_files):
+        """
+        Starts staging the given files in the background, as far as the budget allows.
+        @param input_files: input files of the upcoming task
+        """
+        for input_file in input_files:
+            size = os.stat(input_file).st_size
+            with self.lock:
+                if input_file in self.staged or self.staged_bytes + size > self.budget:
+                    continue
+                self.staged_bytes = self.staged_bytes + size
+                self.staged[input_file] = (self.executor.submit(self._stage, input_file), size)
+
+    def path(self, input_file):
+        """
+        Returns the path the input file should be read from. If it is still being staged, this waits for it (the data
+        is already on its way).
+        @param input_file: input file of the current task
+        @return: path of the staged copy or input_file itself
+        """
+        with self.lock:
+            staged = self.staged.get(input_file)
+        if staged is None:
+            return input_file
+        try:
+            return staged[0].result()
+        except OSError as err:  # e.g. the node-local disk is full : read the original
+            print("WARNING: Staging of {0} failed ({1})".format(input_file, err))
+            return input_file
+
+    def release(self, input_files):
+        """
+        Removes the staged copies of a finished task and gives their bytes back to the budget.
+        @param input_files: input files of the finished task
+        """
+        for input_file in input_files:
+            with self.lock:
+                staged = self.staged.pop(input_file, None)
+            if staged is None:
+                continue
+            future, size = staged
+            try:
+                staged_path = future.result()
+                if staged_path != input_file and os.path.isfile(staged_path):
+                    os.remove(staged_path)
+            except OSError:
+                pass
+            with self.lock:
+                self.staged_bytes = self.staged_bytes - size
+
+    def shutdown(self):
+        """
+        Stops the background thread and removes the remaining copies together with stage_dir.
+        """
+        self.release(list(self.staged))
+        self.executor.shutdown()
+        if self.stage_dir is not None:
+            shutil.rmtree(self.stage_dir, ignore_errors=True)
+
+    def _stage(self, input_file):
+        """
+        Copies input_file into stage_dir (renamed when complete) or reads it ahead into the page cache.
+        @return: path to read the file from
+        """
+        if self.stage_dir is None:
+            with open(input_file, "rb") as in_file:
+                if hasattr(os, "posix_fadvise"):
+                    os.posix_fadvise(in_file.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+                else:
+                    while in_file.read(1 << 24):
+                        pass
+            return input_file
+        staged_path = "{0}/{1}".format(self.stage_dir, os.path.basename(input_file))
+        partial_path = "{0}/.partial-{1}".format(self.stage_dir, os.path.basename(input_file))
+        shutil.copyfile(input_file, partial_path)
+        os.replace(partial_path, staged_path)
+        return staged_path
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the modules of the pipeline import each other by their plain names (run from pipeline/)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "pipeline"))
@@ -0,0 +1,59 @@
+import os
+
+from catalog import open_catalog
+from catalog import catalog_scanner
+from catalog import mark_processed
+from catalog import incomplete_days
+
+
+def input_files(month_dir, day, members, hours):
+    day_dir = month_dir / day
+    day_dir.mkdir(parents=True, exist_ok=True)
+    paths = []
+    for member in members:
+        for hour in hours:
+            path = day_dir / "cde2020{0}{1}.{2:02d}.m{3:02d}.grib2".format(month_dir.name, day, hour, member)
+            path.write_bytes(b"GRIB" * 256)
+            paths.append(str(path))
+    return paths
+
+
+def test_catalog_scanner(tmp_path):
+    month_dir = tmp_path / "2020" / "01"
+    input_files(month_dir, "01", [1, 2], [0, 1])
+    input_files(month_dir, "02", [1], [0])
+    connection = open_catalog(str(tmp_path / "catalog.sqlite"))
+
+    dir_detail_list, days, size, num_files, num_directories, file_records = catalog_scanner(connection,
+                                                                                            str(month_dir))
+    assert days == ["01", "02"] and num_files == 5 and num_directories == 2
+    assert dir_detail_list == ["01", 4, 4, "02", 1, 1]
+    assert [record[1:] for record in file_records["01"]] == [(0, "01", 1024), (0, "02", 1024), (1, "01", 1024),
+                                                             (1, "02", 1024)]
+
+    # an in-place rewrite changes neither the directory nor the size of the file, only its mtime
+    paths = [record[0] for record in file_records["01"]]
+    mark_processed(connection, paths)
+    os.utime(paths[0], (1, 1))
+    os.remove(paths[1])
+    catalog_scanner(connection, str(month_dir))
+    stored = dict(connection.execute("SELECT path, processed FROM files WHERE day = '20200101'").fetchall())
+    assert stored == {paths[0]: 0, paths[2]: 1, paths[3]: 1}
+
+
+def test_incomplete_days(tmp_path):
+    month_dir = tmp_path / "2020" / "01"
+    # 01 : complete up to hour 1 (a short archive), 02 : member 02 is missing
+    input_files(month_dir, "01", range(1, 21), [0, 1])
+    input_files(month_dir, "02", [1], [0, 1, 2])
+    other_month = tmp_path / "2020" / "02"
+    input_files(other_month, "01", [1], [0])
+    connection = open_catalog(str(tmp_path / "catalog.sqlite"))
+    catalog_scanner(connection, str(other_month))
+    _, _, _, _, _, file_records = catalog_scanner(connection, str(month_dir))
+
+    assert incomplete_days(connection, str(month_dir), 24) == [("20200101", 40, 40, 0), ("20200102", 3, 60, 0)]
+    mark_processed(connection, [record[0] for record in file_records["01"]])
+    assert incomplete_days(connection, str(month_dir), 24) == [("20200102", 3, 60, 0)]
+    assert incomplete_days(connection, str(month_dir), 1) == [("20200102", 2, 40, 0)]
+    assert incomplete_days(connection, str(other_month), 24) == [("20200201", 1, 20, 0)]
@@ -0,0 +1,69 @@
+import glob
+import os
+
+import numpy as np
+import pytest
+from netCDF4 import Dataset
+
+pytest.importorskip("mpi4py")
+
+from scheduler import master_scheduler
+from prepros import split_and_rename_time_steps
+from prepros import write_native
+from merger import read_time_steps
+from nclock import open_dataset
+
+NUM_STEPS = 6
+SHAPE = (46, 42)  # rlat, rlon
+
+
+def converted_file(path, seed):
+    """
+    Writes a file like the output of grib_to_netcdf() (preproc-cdeYYYYMMDD.FF.mEE.nc) with NUM_STEPS time steps.
+    """
+    data = np.random.RandomState(seed).rand(NUM_STEPS, *SHAPE).astype("f4")
+    with Dataset(path, "w", format="NETCDF4_CLASSIC") as nc_file:
+        nc_file.createDimension("time", None)
+        nc_file.createDimension("rlat", SHAPE[0])
+        nc_file.createDimension("rlon", SHAPE[1])
+        time_var = nc_file.createVariable("time", "f8", ("time",))
+        time_var.units = "hours since 2020-01-01 00:00:00"
+        time_var.calendar = "proleptic_gregorian"
+        time_var[:] = 5. + 3. * np.arange(NUM_STEPS)  # forecast hour 05 of the model runs 00, 03, ..
+        nc_file.createVariable("rlat", "f8", ("rlat",))[:] = np.arange(SHAPE[0])
+        nc_file.createVariable("rlon", "f8", ("rlon",))[:] = np.arange(SHAPE[1])
+        nc_file.createVariable("t", "f4", ("time", "rlat", "rlon"), zlib=True)[:] = data
+    return data
+
+
+def process_task(task):
+    """
+    The in-process netCDF work of a conversion task (split into time steps) followed by the one of a merge task (read
+    the time steps, write the native output), on the files of one task.
+    """
+    task_dir, s_file = task
+    split_and_rename_time_steps(task_dir, s_file)
+    fragments = sorted(glob.glob(task_dir + "/time:*.nc"))
+    stacked = read_time_steps(fragments)
+    with open_dataset(fragments[0], "r") as template:
+        write_native(template, task_dir + "/processed.nc", stacked)
+    return "{0} is done".format(os.path.basename(task_dir))
+
+
+def test_tasks_run_at_the_same_time(tmp_path):
+    tasks = []
+    expected = {}
+    for number in range(0, 16):
+        task_dir = tmp_path / "task{0:02d}".format(number)
+        task_dir.mkdir()
+        s_file = str(task_dir / "preproc-cde20200101.05.m{0:02d}.nc".format(number + 1))
+        expected[str(task_dir)] = converted_file(s_file, number)
+        tasks.append((str(task_dir), s_file))
+
+    reports, left = master_scheduler(tasks, 0, process_task, local_workers=8)
+    assert left == [] and len(reports) == len(tasks)
+    for task_dir, data in expected.items():
+        assert len(glob.glob(task_dir + "/time:*.05.m*.nc")) == NUM_STEPS
+        with Dataset(task_dir + "/processed.nc", "r") as nc_file:
+            assert nc_file.variables["t"].dimensions == ("time", "rlon", "rlat")
+            np.testing.assert_array_equal(nc_file.variables["t"][:], np.transpose(data[:, ::-1, :], (0, 2, 1)))
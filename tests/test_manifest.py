@@ -0,0 +1,43 @@
+from datetime import datetime
+
+from manifest import manifest_entry
+from manifest import read_manifest
+from manifest import append_manifest
+from manifest import pending_tasks
+from manifest import clean_partial_data
+
+
+def test_manifest_entries():
+    assert manifest_entry(("20200101", "/in/20200101/cde20200101.05.m02.grib2")) == \
+        "convert 20200101 cde20200101.05.m02.grib2"
+    assert manifest_entry(("20200101", "t", "02")) == "accumulate 20200101 t 02"
+    merge_task = ("20200101", "t", datetime(2020, 1, 1, 3), "02")
+    assert manifest_entry(merge_task) == "merge 20200101 t 2020010103 02"
+    assert manifest_entry(merge_task + (["time:20200101-03.00.m02.nc"], None)) == manifest_entry(merge_task)
+
+
+def test_pending_tasks(tmp_path):
+    manifest_file = str(tmp_path / "manifest.txt")
+    tasks = [("20200101", "t", datetime(2020, 1, 1, 3 * run), "02") for run in range(0, 8)]
+    assert read_manifest(manifest_file) == set()
+    assert pending_tasks(tasks, read_manifest(manifest_file)) == tasks
+
+    append_manifest(manifest_file, [tasks[5], tasks[1]])
+    append_manifest(manifest_file, [tasks[1] + ([], None)])
+    assert pending_tasks(tasks, read_manifest(manifest_file)) == [tasks[0]] + tasks[2:5] + tasks[6:]
+    # the time steps attached by merge_tasks_indexer() do not change the entry
+    assert pending_tasks([task + ([], None) for task in tasks[:2]], read_manifest(manifest_file)) == [tasks[0] + ([], None)]
+
+
+def test_clean_partial_data(tmp_path):
+    day = tmp_path / "20200101"
+    kept = [day / "t" / "time:20200101-03.00.m02.nc", day / "t" / "remapped" / "processed:2020010103.m02.nc",
+            day / "gaps_t.txt"]
+    left = [day / "t" / "remapped" / ".partial-processed:2020010106.m02.nc", day / ".partial-gaps_t.txt",
+            day / "split_cde20200101.00.m02.grib2" / "t.nc", day / "t" / "tempdir_2020010103_m02" / "00.nc"]
+    for path in kept + left:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text("")
+    assert clean_partial_data(str(tmp_path), ["20200101"]) == 4
+    assert all(path.exists() for path in kept)
+    assert not any(path.exists() for path in left)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from merger import deaccumulate_data
+from merger import concatenate_time_steps
+
+
+def test_deaccumulate_data():
+    accumulated = np.ma.masked_array([[[0., 1.]], [[2., 3.]], [[5., 3.]], [[9., 4.]]],
+                                     mask=[[[False, False]], [[False, True]], [[False, False]], [[False, False]]])
+    stacked = {"time": np.arange(4.), "time_bnds": np.array([[0., 0.], [0., 1.], [0., 2.], [0., 3.]]),
+               "tp": accumulated, "tp_point": np.ma.masked_array([1., 3., 6., 6.])}
+    hourly = deaccumulate_data(stacked)
+    np.testing.assert_array_equal(hourly["time"], np.arange(4.))
+    np.testing.assert_array_equal(hourly["time_bnds"][:, 1], np.arange(4.))
+    np.testing.assert_array_equal(hourly["tp"][:, 0, 0], [0., 2., 3., 4.])
+    np.testing.assert_array_equal(hourly["tp_point"], [1., 2., 3., 0.])  # data variables of any shape
+    # a missing value in one of the two hours gives a missing value (like cdo sub)
+    np.testing.assert_array_equal(np.ma.getmaskarray(hourly["tp"][:, 0, 1]), [False, True, True, False])
+    assert hourly["tp"][3, 0, 1] == 1.
+
+
+def test_concatenate_time_steps():
+    first = {"time": np.arange(2.), "t": np.ma.zeros((2, 1, 2))}
+    missing = {"time": np.arange(2., 4.), "time_bnds": np.zeros((2, 2)), "t": np.ma.masked_all((2, 1, 2))}
+    stacked = concatenate_time_steps([missing, first])
+    assert sorted(stacked) == ["t", "time"]
+    np.testing.assert_array_equal(stacked["time"], [2., 3., 0., 1.])
+    assert stacked["t"].shape == (4, 1, 2)
+    assert np.ma.getmaskarray(stacked["t"][:2]).all() and not np.ma.getmaskarray(stacked["t"][2:]).any()
+
+    with pytest.raises(ValueError, match="tp"):
+        concatenate_time_steps([first, {"time": np.arange(2., 4.), "tp": np.ma.zeros((2, 1, 2))}])
@@ -0,0 +1,60 @@
+from datetime import datetime
+
+from planner import NUM_RUNS
+from planner import NUM_MEMBERS
+from planner import NUM_HOURS
+from planner import MergePlan
+from planner import plan_hours
+from planner import availability_bitmap
+from planner import plan_bitmap
+from planner import write_gap_report
+
+
+def test_plan_full_runs():
+    assert plan_hours(range(0, 25), False) == MergePlan("full", 24, 24, [])
+    assert plan_hours(range(0, 22), True) == MergePlan("full", 21, 21, [])
+
+
+def test_plan_fill():
+    hours = [hour for hour in range(0, 25) if hour != 5]
+    assert plan_hours(hours, False) == MergePlan("fill", 24, -1, [5])
+    assert plan_hours([0, 1, 2], False) == MergePlan("fill", 21, -1, list(range(3, 22)))
+
+
+def test_plan_break():
+    hours = list(range(0, 10)) + [12, 22]
+    assert plan_hours(hours, True) == MergePlan("break", 24, 9, list(range(10, 25)))
+
+
+def test_plan_missing():
+    assert plan_hours([1, 2], True) == MergePlan("missing", 21, -1, list(range(0, 22)))
+    assert plan_hours([], False) == MergePlan("missing", 21, -1, list(range(0, 22)))
+    assert plan_hours([], True) == MergePlan("missing", 21, -1, list(range(0, 22)))
+
+
+def test_availability_bitmap():
+    index = {("20200101-03", "02"): ["/data/20200101/t/time:20200101-03.05.m02.nc",
+                                      "/data/20200101/t/time:20200101-03.30.m02.nc"],
+             ("20200101-21", "20"): ["/data/20200101/t/time:20200101-21.24.m20.nc"],
+             ("20200102-00", "01"): ["/data/20200101/t/time:20200102-00.00.m01.nc"]}
+    bitmap = availability_bitmap(index, datetime(2020, 1, 1))
+    assert bitmap.shape == (NUM_RUNS, NUM_MEMBERS, NUM_HOURS)
+    assert bitmap.sum() == 2
+    assert bitmap[1, 1, 5] and bitmap[7, 19, 24]
+
+
+def test_empty_day(tmp_path):
+    bitmap = availability_bitmap({}, datetime(2020, 1, 1))
+    assert not bitmap.any()
+    plans = plan_bitmap(bitmap, True)
+    assert len(plans) == NUM_RUNS * NUM_MEMBERS
+    assert {plan.strategy for plan in plans.values()} == {"missing"}
+
+    report_file = tmp_path / "gaps_t.txt"
+    write_gap_report(str(report_file), bitmap, plans, "gap report of t on 2020-01-01")
+    lines = report_file.read_text().splitlines()
+    assert lines[0] == "# gap report of t on 2020-01-01"
+    assert len(lines) == 2 + NUM_RUNS * NUM_MEMBERS + 1
+    assert lines[2] == "00 01 " + "." * NUM_HOURS + " missing"
+    assert lines[-1] == "# 0 of 4000 time steps available, missing: 160"
+    assert [path.name for path in tmp_path.iterdir()] == ["gaps_t.txt"]
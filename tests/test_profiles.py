@@ -0,0 +1,45 @@
+import pytest
+
+from profiles import OutputProfile
+from profiles import default_profile
+from profiles import parse_profile
+from profiles import chunk_sizes
+from profiles import nccopy_options
+
+
+def test_default_profile_is_written_by_cdo():
+    assert parse_profile("", 6) == default_profile(6) == OutputProfile(None, False, "zlib", 6)
+    assert parse_profile("", 0) == OutputProfile(None, False, "none", 0)
+
+
+def test_full_profile():
+    assert parse_profile("6x461x421:shuffle:zlib:4") == OutputProfile((6, 461, 421), True, "zlib", 4)
+    assert parse_profile(" ZLIB : 1x0x0 : 2 ", 6) == OutputProfile((1, 0, 0), False, "zlib", 2)
+
+
+def test_codec_none_drops_shuffle_and_level():
+    assert parse_profile("none", 6) == OutputProfile(None, False, "none", 0)
+    assert parse_profile("shuffle:none:4") == OutputProfile(None, False, "none", 0)
+
+
+def test_zlib_without_level():
+    assert parse_profile("zlib", 0).level == 6
+    assert parse_profile("zlib", 3).level == 3
+
+
+@pytest.mark.parametrize("spec", ["6x461", "6xax421", "-1x0x0", "zlib:10", "lz4"])
+def test_invalid_profiles(spec):
+    with pytest.raises(ValueError):
+        parse_profile(spec)
+
+
+def test_chunk_sizes():
+    profile = parse_profile("6x0x100")
+    assert chunk_sizes(profile, ("time", "rlat", "rlon"), (25, 461, 421)) == [6, 461, 100]
+    assert chunk_sizes(profile, ("time", "bnds"), (3, 2)) == [3, 2]
+    assert chunk_sizes(parse_profile("auto"), ("time", "lat", "lon"), (25, 461, 421)) is None
+
+
+def test_nccopy_options():
+    assert nccopy_options(parse_profile("6x0x0:shuffle:zlib:6")) == "-k nc4c -d 6 -s -c time/6"
+    assert nccopy_options(parse_profile("none", 6)) == "-k nc4c"
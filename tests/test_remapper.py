@@ -0,0 +1,19 @@
+import numpy as np
+import pytest
+
+from remapper import MISSING_VALUE
+from remapper import remap_fields
+
+
+def test_remap_fields_renormalizes_missing_values():
+    sparse = pytest.importorskip("scipy.sparse")  # optional, see remapper.sparse_available()
+    # target cell 0 covers both source cells by half, target cell 1 none of them
+    matrix = sparse.csr_matrix(np.array([[0.5, 0.5], [0., 0.]]))
+    data = np.ma.masked_array([[[2., 4.]], [[2., MISSING_VALUE]], [[2., 4.]], [[1., 1.]]],
+                              mask=[[[False, False]], [[False, False]], [[True, False]], [[True, True]]])
+    remapped = remap_fields(matrix, data, (1, 2))
+    assert remapped.shape == (4, 1, 2)
+    np.testing.assert_allclose(remapped[:3, 0, 0], [3., 2., 4.])
+    assert np.ma.getmaskarray(remapped[:, 0, 1]).all()  # no source cell
+    assert np.ma.getmaskarray(remapped[3]).all()  # all source cells missing
+    assert not np.ma.getmaskarray(remapped[:3, 0, 0]).any()